@@ -1,19 +1,15 @@
-import base64
-import os
-import tempfile
-import json
+import hashlib
+import time
 import streamlit as st
-from langchain.document_loaders import PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from utils.search import query_search_index
-from utils.openai import generate_query_embedding
-from chat import evaluate_snippet
+from utils.metrics import Metrics, use_metrics, summary_to_json, summary_to_prometheus
+from utils.pdf_text import iter_chunks, open_document, get_page_count
+from chat import chat_pack_size
+from pipeline import MAX_WORKERS, annotate_pdf, is_flagged, process_chunks
 import pandas as pd
-import fitz
 
-# Configuration variables
-FILE_TYPE_PDF = "pdf"
-MINIMUM_CHUNK_LENGTH = 100
+# Columns of the results table, and the seconds between redraws while rows stream in
+TABLE_COLUMNS = ["chunk_number", "page_number", "commitment", "is_special_commitment", "confidence", "reason", "tokens", "duplicate_of", "snippet"]
+TABLE_REFRESH_SECONDS = 0.5
 
 def main():
     # Heading
@@ -25,203 +21,125 @@ def main():
     # If a file was uploaded
     if uploaded_file is not None:
         # Get the file data as a bytes object
-        file_data = uploaded_file.read()
-
-        # Save the file data to a temporary PDF file
-        temp_pdf_file_path = save_to_temp_file(file_data)
-
-        # Load the PDF file
-        document = load_pdf(temp_pdf_file_path)
-
-        chunks = split_text(document)
-
-        # Define a list to store the chunks
-        table = []
-
-        # Loop through the chunks and display them
-        with st.spinner("Processing chunks..."):
-            progress_bar = st.progress(0)
-            # Create an empty placeholder
-            text = st.empty()
-            for i, chunk in enumerate(chunks):
-                # Update the progress bar
-                progress_bar.progress((i + 1) / len(chunks))
-
-                # Update the text message
-                message = "Processing Chunk {} of {}...".format(i + 1, len(chunks))
-                text.write(message)
-
-                row = process_chunk(i, chunk)
-                table.append(row)
-            
-            # Empty the placeholder
+        file_data = uploaded_file.getvalue()
+
+        # Number of chunks to process concurrently
+        max_workers = st.sidebar.number_input("Concurrent workers", min_value=1, max_value=32, value=MAX_WORKERS)
+
+        # Classify one representative per cluster of near-identical chunks
+        deduplicate = st.sidebar.checkbox("Deduplicate near-identical chunks", value=True)
+
+        # Chunks of the same commitment classified together in one chat request
+        pack_size = st.sidebar.number_input("Snippets per chat request", min_value=1, max_value=32, value=chat_pack_size)
+
+        # Only list the chunks flagged as special commitments
+        flagged_only = st.sidebar.checkbox("Show flagged chunks only", value=False)
+
+        # Every widget interaction reruns this script, the results of this session are kept until the
+        # document or the options that change them do
+        key = (hashlib.sha256(file_data).hexdigest(), deduplicate, pack_size)
+        table = st.empty()
+        result = st.session_state.get("result")
+        if result is None or result["key"] != key:
+            st.session_state.pop("result", None)
+            result = classify_document(file_data, max_workers, deduplicate, pack_size, table, flagged_only)
+            result["key"] = key
+            st.session_state["result"] = result
+        show_rows(table, result["rows"], flagged_only)
+
+        # Show how many evaluations were served from the result cache during this session's run
+        st.caption(f"Result cache: {result['cache_hits']} hits, {result['cache_misses']} misses")
+        if result["unmatched"]:
+            st.caption(f"{result['unmatched']} flagged snippets could not be located in the PDF.")
+
+        # The CSV and the annotated PDF are served as downloads instead of being inlined in the page
+        st.download_button("Download CSV", result["csv"], file_name="chunks.csv", mime="text/csv")
+        st.download_button("Download Annotated PDF", result["annotated_pdf"], file_name="annotated.pdf", mime="application/pdf")
+
+        # Show where the time of this session's run went
+        show_metrics(result["metrics"])
+
+def classify_document(file_data, max_workers, deduplicate, pack_size, table, flagged_only):
+    # Pages are extracted lazily as the chunks are consumed, long documents in page-range shards across processes
+    num_pages = get_page_count(open_document(file_data))
+    pages_read = 0
+
+    def on_pages(pages):
+        nonlocal pages_read
+        pages_read = pages
+
+    chunks = iter_chunks(file_data, on_pages=on_pages)
+
+    # Loop through the chunks and display them
+    with st.spinner("Processing chunks..."):
+        progress_bar = st.progress(0)
+        # Create an empty placeholder
+        text = st.empty()
+
+        def on_progress(completed, submitted):
+            # Update the progress bar, scaled by the share of pages parsed so far
+            progress_bar.progress(completed / submitted * pages_read / num_pages)
+
+            # Update the text message
+            message = "Processed Chunk {} of {} (page {} of {} parsed)...".format(completed, submitted, pages_read, num_pages)
+            text.write(message)
+
+        # Stream the rows into the table as they finish, redrawn at most every TABLE_REFRESH_SECONDS
+        finished = []
+        last_refresh = 0
+
+        def on_row(row):
+            nonlocal last_refresh
+            finished.append(row)
+            if time.monotonic() - last_refresh >= TABLE_REFRESH_SECONDS:
+                show_rows(table, finished, flagged_only)
+                last_refresh = time.monotonic()
+
+        # Every run records into its own metrics, so sessions running at the same time are kept apart
+        run_metrics = Metrics()
+        with use_metrics(run_metrics):
+            rows = process_chunks(chunks, max_workers, on_progress, deduplicate, pack_size, on_row=on_row)
+
+            # Empty the placeholders
+            progress_bar.empty()
             text.empty()
 
-            # Convert the chunks to a DataFrame
-            df = pd.DataFrame(table)
-
-            # Add a button to export the table to CSV
-            csv = df.to_csv(index=False)
-            b64 = base64.b64encode(csv.encode()).decode()
-            href = f'<a href="data:file/csv;base64,{b64}" download="chunks.csv">Download CSV</a>'
-            st.markdown(href, unsafe_allow_html=True)
-
-            # Annotate PDF
-            annotate_pdf(temp_pdf_file_path, df)
-
-            #  Render PDF
-            with open("annotated.pdf", "rb") as f:
-                contents = f.read()
-                data_url = base64.b64encode(contents).decode("utf-8")
-                pdf_embed = f'<object type="application/pdf" data="data:application/pdf;base64,{data_url}" width="700" height="1000"></object>'
-            st.markdown(pdf_embed, unsafe_allow_html=True)
-
-def annotate_pdf(pdf_file_path, df):
-    # Open the PDF file
-    doc = fitz.open(pdf_file_path)
-
-    # Loop through each row in the DataFrame
-    for index, row in df.iterrows():
-        if row["is_special_commitment"]:
-            # Get the corresponding snippet of text
-            snippet = row["snippet"]
-            # Search for the snippet in the PDF
-            for page in doc:
-                text_instances = page.search_for(snippet)
-                # Highlight the matching text in yellow
-                for inst in text_instances:
-                    highlight = page.add_highlight_annot(inst)
-                    highlight.update()
-
-    # Save the annotated PDF file
-    doc.save("annotated.pdf")
-
-    # Add a download link for the annotated PDF
-    with open("annotated.pdf", "rb") as f:
-        contents = f.read()
-        data_url = base64.b64encode(contents).decode("utf-8")
-        download_link = f'<a href="data:application/octet-stream;base64,{data_url}" download="annotated.pdf">Download Annotated PDF</a>'
-
-    # Display the download link in the Streamlit app
-    st.markdown(download_link, unsafe_allow_html=True)
-
-def process_chunk(i, chunk):
-    # 1. OpenAI - Generate the query embedding
-    snippet = chunk["chunk"]
-    embedding = generate_query_embedding(snippet)
-
-    # 2. Cognitive Search - Query the search index
-    query_results = query_search_index(embedding, 1)
-    commitment = query_results["value"][0]["category"]
-
-    # Get the policy and examples for the commitment
-    examples_doc = get_examples_doc()
-    policy = examples_doc[commitment]["policy"]
-    examples = examples_doc[commitment]["examples"]
-
-    # 3. OpenAI - Evaluate the snippet
-    eval = evaluate_snippet(commitment, policy, examples, snippet)
-    is_special_commitment, confidence, reason, eval = unpack_eval(eval)
-
-    # Display the chunk
-    row = {
-        "chunk_number": i,
-        "page_number": chunk["page_number"]+1,
-        "snippet": snippet,
-        "commitment": commitment,
-        "is_special_commitment": is_special_commitment,
-        "confidence": confidence,
-        "reason": reason,
-        "eval": eval
+            # Annotate PDF, the result only exists in this session's memory
+            with run_metrics.timed("annotate_pdf"):
+                annotated_pdf, unmatched = annotate_pdf(file_data, rows)
+        summary = run_metrics.summary()
+
+    # This run's metrics are kept with its results instead of being read again on the next rerun
+    cache_stats = summary["usage"].get("result_cache", {})
+    return {
+        "rows": rows,
+        "csv": pd.DataFrame(rows).to_csv(index=False),
+        "annotated_pdf": annotated_pdf,
+        "unmatched": unmatched,
+        "cache_hits": cache_stats.get("hits", 0),
+        "cache_misses": cache_stats.get("misses", 0),
+        "metrics": summary,
     }
-    return row
-
-def unpack_eval(eval):
-    if isinstance(eval, str):
-        try:
-            eval = json.loads(eval)
-        except json.JSONDecodeError:
-            return None, None, None, eval
-
-    is_special_commitment = eval.get("is_special_commitment")
-    if isinstance(is_special_commitment, str):
-        is_special_commitment = is_special_commitment.upper()
-
-    confidence = eval.get("confidence")
-    if isinstance(confidence, str):
-        confidence = confidence.upper()
-
-    reason = eval.get("reason")
-
-    return is_special_commitment, confidence, reason, eval
-
-def get_examples_doc():
-    # Load the examples from from messages/examples.json and return the dictionary
-    with open(os.path.join(os.path.dirname(__file__), "messages", "examples.json"), "r") as f:
-        examples = json.load(f)
-    return examples
-
-def save_to_temp_file(file_data):
-    # Create a temporary file to write the uploaded file data to
-    with tempfile.NamedTemporaryFile(suffix=f".{FILE_TYPE_PDF}", delete=False) as temp_file:
-        temp_file.write(file_data)
-
-    # Get the full path of the temporary file
-    temp_file_path = os.path.abspath(temp_file.name)
-
-    return temp_file_path
-
-def load_pdf(file_path):
-    # Create a PDF loader object
-    loader = PyPDFLoader(file_path)
-
-    # Load the PDF file
-    document = loader.load()
-
-    return document
-
-def split_text(document):
-    # Concatenate the page content of all documents into one variable
-    text = ""
-    page_indicator_prefix = "[METADATA]PAGE:"
-    page_indicator_suffix = ":"
-    for page in document:
-        text += page_indicator_prefix + str(page.metadata["page"]) + page_indicator_suffix + "\n\n"
-        text += page.page_content
-
-    # Create a text splitter object
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=100
-    )
-
-    # Split the text into chunks
-    chunks = splitter.split_text(text)
-
-    # Loop through the chunks and extract the page number
-    current_page_number = None
-    chunks_with_page_numbers = []
-    for i, chunk in enumerate(chunks):
-        chunk_dict = {}
-        # Check if the chunk contains a page number tag
-        if page_indicator_prefix in chunk:
-            # Extract the page number from the tag
-            page_number = int(chunk.split(page_indicator_prefix)[1].split(page_indicator_suffix)[0])
-
-            # Update the current page number
-            current_page_number = page_number
-
-            # Remove the page number tag from the chunk
-            chunk = chunk.replace(f"{page_indicator_prefix}{page_number}{page_indicator_suffix}", "")
-            chunk = chunk.strip()
-
-        # Add the chunk and the page number to the list if the chunk length is greater than the minimum length
-        if len(chunk) > MINIMUM_CHUNK_LENGTH:
-            chunk_dict["chunk"] = chunk
-            chunk_dict["page_number"] = current_page_number
-            chunks_with_page_numbers.append(chunk_dict)
-
-    return chunks_with_page_numbers
+
+def show_rows(table, rows, flagged_only=False):
+    # Draw the rows in chunk order, the evaluation details are only part of the CSV
+    if flagged_only:
+        rows = [row for row in rows if is_flagged(row["is_special_commitment"])]
+    rows = sorted(rows, key=lambda row: row["chunk_number"])
+    table.dataframe(pd.DataFrame(rows, columns=TABLE_COLUMNS), hide_index=True)
+
+def show_metrics(summary):
+    with st.expander("Run metrics"):
+        st.write("Elapsed: {:.2f}s".format(summary["elapsed"]))
+        stages = pd.DataFrame([dict(stage=stage, **stats) for stage, stats in summary["stages"].items()])
+        st.dataframe(stages)
+        for service, stats in summary["requests"].items():
+            st.write(f"{service}: {stats['count']} requests, {stats['retries']} retries, status codes {stats['status_codes']}, "
+                     f"{stats['request_bytes']} bytes sent, {stats['response_bytes']} bytes received")
+        for service, usage in summary["usage"].items():
+            st.write(f"{service} token usage: {usage}")
+        st.download_button("Download metrics (JSON)", summary_to_json(summary), file_name="metrics.json", mime="application/json")
+        st.download_button("Download metrics (Prometheus)", summary_to_prometheus(summary), file_name="metrics.prom", mime="text/plain")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,211 @@
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+# Dimensions of the mock embeddings, matching text-embedding-ada-002
+EMBEDDING_DIMENSIONS = 1536
+
+class MockSettings:
+    """Latency and failure injection shared by the mock endpoints."""
+
+    def __init__(self, latency_ms=20, jitter_ms=5, error_rate=0.0, throttle_rate=0.0, retry_after_ms=50):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after_ms = retry_after_ms
+
+class MockIndex:
+    """In-memory stand-in for one Azure Cognitive Search index."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.documents = {}
+        self.fields = []
+        self.matrix = None
+        self.keys = []
+
+    def upsert(self, documents):
+        with self.lock:
+            for document in documents:
+                if document.get("@search.action") == "delete":
+                    self.documents.pop(document["id"], None)
+                else:
+                    self.documents[document["id"]] = {key: value for key, value in document.items() if not key.startswith("@")}
+            self.matrix = None
+
+    def search(self, vector, k):
+        with self.lock:
+            if self.matrix is None:
+                self.keys = list(self.documents)
+                vectors = np.array([self.documents[key]["contentVector"] for key in self.keys], dtype=np.float32).reshape(len(self.keys), -1)
+                norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+                norms[norms == 0] = 1
+                self.matrix = vectors / norms
+            if not self.keys:
+                return []
+            query = np.asarray(vector, dtype=np.float32)
+            scores = self.matrix @ (query / (np.linalg.norm(query) or 1))
+            top = np.argsort(-scores)[:k]
+            return [
+                dict(
+                    {"@search.score": float(scores[i])},
+                    **{key: value for key, value in self.documents[self.keys[i]].items() if key != "contentVector"},
+                )
+                for i in top
+            ]
+
+def mock_embedding(text):
+    # Deterministic pseudo-random unit vector per text, so identical texts embed identically
+    seed = int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big")
+    vector = np.random.default_rng(seed).standard_normal(EMBEDDING_DIMENSIONS).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+class MockAzureHandler(BaseHTTPRequestHandler):
+    """Implements the Azure OpenAI and Cognitive Search REST endpoints used by this repository."""
+
+    protocol_version = "HTTP/1.1"
+    settings = MockSettings()
+    indexes = {}
+    indexes_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body=None, headers=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length)) if length else None
+
+    def inject(self):
+        # Simulate service latency, then fail or throttle a share of the requests. Returns True when handled
+        settings = self.settings
+        time.sleep(max(0, random.gauss(settings.latency_ms, settings.jitter_ms)) / 1000)
+        roll = random.random()
+        if roll < settings.throttle_rate:
+            self.send_json(429, {"error": {"code": "429", "message": "Rate limit exceeded"}}, {
+                "Retry-After": str(max(1, settings.retry_after_ms // 1000)),
+                "retry-after-ms": str(settings.retry_after_ms),
+            })
+            return True
+        if roll < settings.throttle_rate + settings.error_rate:
+            self.send_json(500, {"error": {"code": "500", "message": "Injected failure"}})
+            return True
+        return False
+
+    def get_index(self, name, create=False):
+        with self.indexes_lock:
+            if create and name not in self.indexes:
+                self.indexes[name] = MockIndex()
+            return self.indexes.get(name)
+
+    def do_GET(self):
+        if self.inject():
+            return
+        match = re.match(r"^/indexes/([^/?]+)\?", self.path)
+        index = self.get_index(match.group(1)) if match else None
+        if index is not None:
+            self.send_json(200, {"name": match.group(1), "fields": index.fields})
+        else:
+            self.send_json(404, {"error": {"message": "Not found"}})
+
+    def do_PUT(self):
+        body = self.read_json()
+        if self.inject():
+            return
+        match = re.match(r"^/indexes/([^/?]+)\?", self.path)
+        if not match:
+            self.send_json(404, {"error": {"message": "Not found"}})
+            return
+        self.get_index(match.group(1), create=True).fields = body.get("fields", [])
+        self.send_json(201, body)
+
+    def do_DELETE(self):
+        if self.inject():
+            return
+        match = re.match(r"^/indexes/([^/?]+)\?", self.path)
+        with self.indexes_lock:
+            existed = match is not None and self.indexes.pop(match.group(1), None) is not None
+        self.send_json(204 if existed else 404)
+
+    def do_POST(self):
+        body = self.read_json()
+        if self.inject():
+            return
+        path = self.path.split("?")[0]
+        if path.endswith("/embeddings"):
+            inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+            tokens = sum(estimate_tokens(text) for text in inputs)
+            self.send_json(200, {
+                "data": [{"index": i, "embedding": mock_embedding(text)} for i, text in enumerate(inputs)],
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            })
+        elif path.endswith("/chat/completions"):
+            tokens = sum(estimate_tokens(message["content"]) for message in body["messages"])
+            verdict = {"is_special_commitment": "FALSE", "confidence": "LOW", "reason": "Mock evaluation."}
+            content = json.dumps(verdict)
+            # Packed classification requests list the snippets as a JSON array after "Snippets: "
+            last = body["messages"][-1]["content"]
+            if last.startswith("Review each of the snippets") and "Snippets: " in last:
+                snippets = json.loads(last.split("Snippets: ", 1)[1])
+                content = json.dumps([dict(verdict, id=snippet["id"]) for snippet in snippets])
+            self.send_json(200, {
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+                "usage": {"prompt_tokens": tokens, "completion_tokens": 20, "total_tokens": tokens + 20},
+            })
+        elif re.match(r"^/indexes/[^/]+/docs/index$", path):
+            index = self.get_index(path.split("/")[2], create=True)
+            index.upsert(body["value"])
+            self.send_json(200, {"value": [{"key": document["id"], "status": True, "errorMessage": None, "statusCode": 200} for document in body["value"]]})
+        elif re.match(r"^/indexes/[^/]+/docs/search$", path):
+            index = self.get_index(path.split("/")[2])
+            if index is None:
+                self.send_json(404, {"error": {"message": "Index not found"}})
+                return
+            self.send_json(200, {"value": index.search(body["vector"]["value"], body["vector"]["k"])})
+        else:
+            self.send_json(404, {"error": {"message": "Not found"}})
+
+def start_mock_server(settings=None, port=0):
+    # Start the mock server on a background thread and return it, server.server_address holds the port
+    handler = type("Handler", (MockAzureHandler,), {"settings": settings or MockSettings(), "indexes": {}, "indexes_lock": threading.Lock()})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    # Parse command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8080, help="the port to listen on")
+    parser.add_argument("--latency-ms", type=float, default=20, help="the mean latency added to every request")
+    parser.add_argument("--jitter-ms", type=float, default=5, help="the standard deviation of the added latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="the share of requests failing with 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="the share of requests throttled with 429")
+    args = parser.parse_args()
+
+    server = start_mock_server(MockSettings(args.latency_ms, args.jitter_ms, args.error_rate, args.throttle_rate), args.port)
+    print(f"Mock Azure OpenAI and Cognitive Search listening on http://127.0.0.1:{server.server_address[1]}", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,284 @@
+import argparse
+import json
+import os
+import random
+import resource
+import runpy
+import subprocess
+import sys
+import tempfile
+import time
+
+# Run from anywhere, the repository root holds the scripts and the utils package
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+CATEGORIES = ["Confidentiality", "Non-Compete", "Payment Terms", "Termination", "Governing Law"]
+WORDS = "the party shall not disclose any information agreement term notice days written consent payment invoice within thirty sixty breach obligation law court jurisdiction employee customer supplier period".split()
+
+# The stage whose latency is reported for each case
+LATENCY_STAGES = {
+    "populate": "request:embeddings",
+    "populate_sync": "request:embeddings",
+    "pipeline": "process_chunk",
+    "cli_query": "request:search",
+    "cli_classify": "request:chat",
+}
+
+CONFIG_TEMPLATE = """[openai]
+openai_api_key = mock
+openai_api_base = {endpoint}/
+openai_api_version = 2023-05-15
+openai_service_name = mock
+openai_endpoint = {endpoint}
+embedding_deployment_name = text-embedding-ada-002
+chat_deployment_name = gpt-35-turbo
+
+[search]
+index_name = benchmark
+search_service_name = mock
+search_api_key = mock
+search_endpoint = {endpoint}
+backend = {backend}
+local_index_path = {workdir}/index.npz
+manifest_path = {workdir}/index_manifest.json
+embedding_store_path = {workdir}/embeddings
+
+[cache]
+embedding_cache_enabled = {cache}
+embedding_cache_path = {workdir}/embeddings.sqlite
+result_cache_enabled = {cache}
+result_cache_path = {workdir}/results.sqlite
+"""
+
+def synthetic_text(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+def synthetic_documents(size, seed=0):
+    rng = random.Random(seed)
+    return [{"category": CATEGORIES[i % len(CATEGORIES)], "content": synthetic_text(rng, rng.randint(20, 80))} for i in range(size)]
+
+def synthetic_examples():
+    # Policy and few-shot examples per category, in the messages/examples.json format
+    example = {"snippet": "The party shall not disclose any information.", "is_special_commitment": "TRUE", "confidence": "HIGH", "reason": "Example."}
+    return {category: {"policy": f"Obligations related to {category.lower()}.", "examples": [example] * 3} for category in CATEGORIES}
+
+def synthetic_pdf(pages, seed=0):
+    import fitz
+    rng = random.Random(seed)
+    doc = fitz.open()
+    for _ in range(pages):
+        page = doc.new_page()
+        page.insert_textbox(fitz.Rect(50, 50, 550, 800), "\n\n".join(synthetic_text(rng, 60) for _ in range(6)), fontsize=9)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+def populate_index(documents, workdir, sync=False):
+    # Write the documents to data/documents.json and load them with populate_vector_index.py, returning its run time.
+    # The script reads the file relative to the working directory
+    os.makedirs(os.path.join(workdir, "data"), exist_ok=True)
+    with open(os.path.join(workdir, "data", "documents.json"), "w") as f:
+        json.dump(documents, f)
+    os.chdir(workdir)
+    return run_script("populate_vector_index.py", ["--sync"] if sync else [])
+
+# Each case prepares its inputs, then returns the number of items processed and the seconds the timed part took
+
+def case_populate(size, workdir):
+    return size, populate_index(synthetic_documents(size), workdir)
+
+def case_populate_sync(size, workdir):
+    # Replace a tenth of an indexed corpus, the sync embeds and uploads the new documents and deletes the old ones
+    documents = synthetic_documents(size)
+    populate_index(documents, workdir)
+    changed = max(1, size // 10)
+    documents = documents[changed:] + synthetic_documents(changed, seed=1)
+    return changed, populate_index(documents, workdir, sync=True)
+
+def case_pipeline(pages, workdir):
+    import pipeline
+    from utils.pdf_text import iter_chunks
+
+    populate_index(synthetic_documents(200), workdir)
+    examples = synthetic_examples()
+    pipeline.get_examples_doc = lambda: examples
+    data = synthetic_pdf(pages)
+    pipeline.metrics.reset()
+    start = time.perf_counter()
+    rows = pipeline.process_chunks(iter_chunks(data), pipeline.MAX_WORKERS)
+    return len(rows), time.perf_counter() - start
+
+def case_cli_query(records, workdir):
+    populate_index(synthetic_documents(200), workdir)
+    rng = random.Random(1)
+    input_path = os.path.join(workdir, "queries.jsonl")
+    with open(input_path, "w") as f:
+        for _ in range(records):
+            f.write(json.dumps({"query": synthetic_text(rng, 30)}) + "\n")
+    return records, run_script("query_vector_index.py", ["--input", input_path, "--output", os.path.join(workdir, "results.jsonl")])
+
+def case_cli_classify(records, workdir):
+    # classify_text_snippet.py reads messages/fitness.json relative to the working directory
+    os.makedirs(os.path.join(workdir, "messages"), exist_ok=True)
+    with open(os.path.join(workdir, "messages", "fitness.json"), "w") as f:
+        json.dump([{"role": "system", "content": "Classify the snippet."}], f)
+    rng = random.Random(2)
+    input_path = os.path.join(workdir, "snippets.jsonl")
+    with open(input_path, "w") as f:
+        for _ in range(records):
+            f.write(json.dumps({"snippet": synthetic_text(rng, 30)}) + "\n")
+    os.chdir(workdir)
+    return records, run_script("classify_text_snippet.py", ["--input", input_path, "--output", os.path.join(workdir, "results.jsonl")])
+
+def run_script(name, arguments):
+    # Run the script as __main__ in this interpreter, so that its requests show up in the run metrics
+    from utils.metrics import metrics
+    metrics.reset()
+    sys.argv = [name] + arguments
+    start = time.perf_counter()
+    runpy.run_path(os.path.join(REPO_ROOT, name), run_name="__main__")
+    return time.perf_counter() - start
+
+def start_mock_process(settings):
+    # Start a private mock server in its own process, so that neither its memory nor its threads count
+    # against the process under test. Return the process with the endpoint it printed once listening
+    command = [
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_azure.py"), "--port", "0",
+        "--latency-ms", str(settings.latency_ms), "--jitter-ms", str(settings.jitter_ms),
+        "--error-rate", str(settings.error_rate), "--throttle-rate", str(settings.throttle_rate),
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if "http://" not in line:
+        process.kill()
+        raise RuntimeError("Mock server failed to start")
+    return process, line.strip().split()[-1]
+
+def run_case(case, size, settings, backend, cache):
+    # Run one case in this process against a private mock server, returning its measurements
+    server, endpoint = start_mock_process(settings)
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            config_path = os.path.join(workdir, "config.ini")
+            with open(config_path, "w") as f:
+                f.write(CONFIG_TEMPLATE.format(endpoint=endpoint, backend=backend, workdir=workdir, cache=str(cache).lower()))
+            os.environ["VECTORDB_CONFIG"] = config_path
+
+            from utils.metrics import metrics
+            if case == "populate":
+                items, elapsed = case_populate(size, workdir)
+            elif case == "populate_sync":
+                items, elapsed = case_populate_sync(size, workdir)
+            elif case == "pipeline":
+                items, elapsed = case_pipeline(size, workdir)
+            elif case == "cli_query":
+                items, elapsed = case_cli_query(size, workdir)
+            else:
+                items, elapsed = case_cli_classify(size, workdir)
+            os.chdir(REPO_ROOT)
+    finally:
+        server.terminate()
+        server.wait()
+
+    summary = metrics.summary()
+    return {
+        "case": case,
+        "size": size,
+        "items": items,
+        "seconds": elapsed,
+        "throughput": items / elapsed if elapsed else 0,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": {stage: {key: stats[key] for key in ("count", "p50", "p99")} for stage, stats in summary["stages"].items()},
+        "requests": summary["requests"],
+    }
+
+def run_isolated(case, size, args):
+    # Every case runs in a fresh interpreter so that module state and peak memory are not shared
+    command = [
+        sys.executable, os.path.abspath(__file__), "--case", case, "--size", str(size),
+        "--latency-ms", str(args.latency_ms), "--error-rate", str(args.error_rate),
+        "--throttle-rate", str(args.throttle_rate), "--backend", args.backend,
+    ]
+    if args.cache:
+        command.append("--cache")
+    completed = subprocess.run(command, capture_output=True, text=True, cwd=REPO_ROOT)
+    if completed.returncode != 0:
+        raise RuntimeError(f"Benchmark {case} ({size}) failed:\n{completed.stderr}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def print_report(results, baseline=None):
+    baseline_throughput = {(result["case"], result["size"]): result["throughput"] for result in (baseline or [])}
+    print(f"{'case':<14}{'size':>8}{'items/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'peak MB':>10}{'vs base':>10}")
+    for result in results:
+        # Latency is reported for the unit of work of each case
+        stage = LATENCY_STAGES[result["case"]]
+        stats = result["stages"].get(stage, {"p50": 0, "p99": 0})
+        previous = baseline_throughput.get((result["case"], result["size"]))
+        change = f"{(result['throughput'] / previous - 1) * 100:+.1f}%" if previous else "-"
+        print(f"{result['case']:<14}{result['size']:>8}{result['throughput']:>12.1f}{stats['p50'] * 1000:>10.1f}{stats['p99'] * 1000:>10.1f}{result['peak_rss_mb']:>10.1f}{change:>10}")
+
+def find_regressions(results, baseline, tolerance):
+    baseline_throughput = {(result["case"], result["size"]): result["throughput"] for result in baseline}
+    return [
+        result for result in results
+        if (result["case"], result["size"]) in baseline_throughput
+        and result["throughput"] < baseline_throughput[(result["case"], result["size"])] * (1 - tolerance)
+    ]
+
+if __name__ == "__main__":
+    # Parse command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", default="populate,populate_sync,pipeline,cli_query,cli_classify", help="comma-separated cases to run")
+    parser.add_argument("--populate-sizes", default="100,1000", help="comma-separated corpus sizes for the populate cases")
+    parser.add_argument("--pipeline-pages", default="10,50", help="comma-separated PDF page counts for the pipeline case")
+    parser.add_argument("--cli-records", default="100,1000", help="comma-separated record counts for the CLI cases")
+    parser.add_argument("--latency-ms", type=float, default=20, help="the mean latency of the mock services")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="the share of mock requests failing with 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="the share of mock requests throttled with 429")
+    parser.add_argument("--backend", default="azure", choices=["azure", "local"], help="the search backend to benchmark")
+    parser.add_argument("--cache", action="store_true", help="keep the embedding and result caches enabled")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare the throughput against the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="the throughput drop against the baseline treated as a regression")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    from mock_azure import MockSettings
+    settings = MockSettings(args.latency_ms, args.latency_ms / 4, args.error_rate, args.throttle_rate)
+
+    if args.case:
+        # Single case in an isolated interpreter, the last line of output is the result
+        print(json.dumps(run_case(args.case, args.size, settings, args.backend, args.cache)))
+        sys.exit(0)
+
+    sizes = {
+        "populate": args.populate_sizes,
+        "populate_sync": args.populate_sizes,
+        "pipeline": args.pipeline_pages,
+        "cli_query": args.cli_records,
+        "cli_classify": args.cli_records,
+    }
+    results = []
+    for case in args.cases.split(","):
+        for size in sizes[case].split(","):
+            print(f"Running {case} ({size})...", file=sys.stderr)
+            results.append(run_isolated(case, int(size), args))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+    if baseline is not None:
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for result in regressions:
+            print(f"Regression: {result['case']} ({result['size']}) throughput {result['throughput']:.1f} items/s", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,91 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Run from anywhere, the repository root holds the scripts and the utils package
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Commands whose cold start is measured, each runs in a fresh interpreter. query runs a real
+# --query search, embedding the query and searching the index through the mock services
+COMMANDS = {
+    "python": ["-c", "pass"],
+    "populate_help": ["populate_vector_index.py", "--help"],
+    "query_help": ["query_vector_index.py", "--help"],
+    "classify_help": ["classify_text_snippet.py", "--help"],
+    "import_clients": ["-c", "import utils.openai, utils.search, chat"],
+    "query": ["query_vector_index.py", "--query", "The party shall give thirty days written notice of termination."],
+}
+
+# Median milliseconds a command other than python may take, the budget is meant for query_vector_index.py --query
+DEFAULT_BUDGET_MS = 1000
+
+def prepare_services(workdir):
+    # Start the mock services without added latency, populate a small index and return the environment pointing at them
+    from mock_azure import MockSettings, start_mock_server
+    from run_benchmarks import CONFIG_TEMPLATE, synthetic_documents
+
+    server = start_mock_server(MockSettings(0, 0))
+    endpoint = f"http://127.0.0.1:{server.server_address[1]}"
+    config_path = os.path.join(workdir, "config.ini")
+    with open(config_path, "w") as f:
+        f.write(CONFIG_TEMPLATE.format(endpoint=endpoint, backend="azure", workdir=workdir, cache="false"))
+    env = dict(os.environ, VECTORDB_CONFIG=config_path)
+
+    # populate_vector_index.py reads data/documents.json relative to the working directory
+    os.makedirs(os.path.join(workdir, "data"))
+    with open(os.path.join(workdir, "data", "documents.json"), "w") as f:
+        json.dump(synthetic_documents(100), f)
+    completed = subprocess.run([sys.executable, os.path.join(REPO_ROOT, "populate_vector_index.py")], cwd=workdir, env=env, capture_output=True, text=True)
+    if completed.returncode != 0 or "Error" in completed.stdout:
+        raise RuntimeError(f"Populating the benchmark index failed:\n{completed.stdout}{completed.stderr}")
+    return server, env
+
+def time_command(arguments, runs, env=None):
+    # Wall-clock milliseconds of each run
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        completed = subprocess.run([sys.executable] + arguments, cwd=REPO_ROOT, env=env, capture_output=True, text=True)
+        elapsed = (time.perf_counter() - start) * 1000
+        # The scripts print request errors instead of exiting with a failure
+        if completed.returncode != 0 or "Error" in completed.stdout:
+            raise RuntimeError(f"{' '.join(arguments)} failed:\n{completed.stdout}{completed.stderr}")
+        timings.append(elapsed)
+    return timings
+
+if __name__ == "__main__":
+    # Parse command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--commands", default=",".join(COMMANDS), help="comma-separated commands to time")
+    parser.add_argument("--runs", type=int, default=10, help="the number of cold starts per command")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS, help="fail when the median start of a command other than python exceeds this, 0 disables the check")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        server, env = prepare_services(workdir)
+        for name in args.commands.split(","):
+            timings = time_command(COMMANDS[name], args.runs, env)
+            results.append({"command": name, "median_ms": statistics.median(timings), "min_ms": min(timings), "max_ms": max(timings)})
+        server.shutdown()
+
+    print(f"{'command':<16}{'median ms':>12}{'min ms':>10}{'max ms':>10}")
+    for result in results:
+        print(f"{result['command']:<16}{result['median_ms']:>12.1f}{result['min_ms']:>10.1f}{result['max_ms']:>10.1f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+    if args.budget_ms:
+        over_budget = [result for result in results if result["command"] != "python" and result["median_ms"] > args.budget_ms]
+        for result in over_budget:
+            print(f"Over budget: {result['command']} median {result['median_ms']:.1f} ms", file=sys.stderr)
+        sys.exit(1 if over_budget else 0)
@@ -1,28 +1,31 @@
 import os
-import configparser
-from langchain.chat_models import AzureChatOpenAI
-from langchain.prompts import (
-    ChatPromptTemplate,
-    SystemMessagePromptTemplate,
-    AIMessagePromptTemplate,
-    HumanMessagePromptTemplate,
-)
-
-# Get the path to the config.ini file
-config_path = os.path.join(os.path.dirname(__file__), 'settings', 'config.ini')
-
-# Read the config.ini file
-config = configparser.ConfigParser()
-config.read(config_path)
+import json
+import threading
+import time
+from utils.config import get_config, get_path, require
+from utils.openai import chat_rate_limiter, estimate_token_count, batch_inputs
+from utils.result_cache import ResultCache
+from utils.metrics import metrics
 
 # Get values from the config file
-os.environ["OPENAI_API_TYPE"] = "azure"
-os.environ["OPENAI_API_VERSION"] = config.get('openai', 'openai_api_version')
-os.environ["OPENAI_API_BASE"] = config.get('openai', 'openai_api_base')
-os.environ["OPENAI_API_KEY"] = config.get('openai', 'openai_api_key')
+config = get_config()
+result_cache_enabled = config.getboolean('cache', 'result_cache_enabled', fallback=True)
+# Relative cache paths are resolved against the repository root
+result_cache_path = get_path('cache', 'result_cache_path', 'cache/results.sqlite')
+result_cache_max_entries = config.getint('cache', 'result_cache_max_entries', fallback=100000)
+result_cache_ttl_seconds = config.getint('cache', 'result_cache_ttl_seconds', fallback=30 * 24 * 60 * 60)
+# Snippets of the same commitment classified in one chat request, 1 sends every snippet on its own
+chat_pack_size = config.getint('classifier', 'chat_pack_size', fallback=8)
+# Estimated tokens of the snippets in one packed request, leaving room for the prefix and the answers
+chat_pack_token_limit = config.getint('classifier', 'chat_pack_token_limit', fallback=2000)
 
-SYSTEM_MSG_TEMPLATE = SystemMessagePromptTemplate.from_template(
-    """
+# Valid values of the fields of a verdict
+VERDICT_VALUES = {
+    "is_special_commitment": ("TRUE", "FALSE"),
+    "confidence": ("HIGH", "MEDIUM", "LOW"),
+}
+
+SYSTEM_MSG = """
     You are a legal assistant. Your primary goal is to identify special commitments in legal documents.
     A special commitment is a clause that obliges one or more parties to do something specific or refrain from doing something in the future.
     Given a legal document, identify if it contains any special commitments related to \"{commitment}\" and list them.
@@ -35,21 +38,63 @@ SYSTEM_MSG_TEMPLATE = SystemMessagePromptTemplate.from_template(
         \"reason\": \"DESCRIPTION OF THE REASON FOR THE PREDICTION\"
     }}
     Your JSON response must always include the three fields above (is_special_commitment, confidence, and reason).
-    """)
-HUMAN_MSG_TEMPLATE = HumanMessagePromptTemplate.from_template("Snippet: {snippet}")
-AI_MSG_TEMPLATE = AIMessagePromptTemplate.from_template("""
+    """
+HUMAN_MSG = "Snippet: {snippet}"
+PACKED_MSG = """Review each of the snippets below on its own, they are given as a JSON array of objects with an "id" and a "snippet".
+Your response must be a JSON array with one object per snippet, each with the snippet's "id" and the three fields above (is_special_commitment, confidence, and reason).
+Snippets: {snippets}"""
+AI_MSG = """
 {{
     \"is_special_commitment\": \"{is_special_commitment}\",
     \"confidence\": \"{confidence}\",
     \"reason\": \"{reason}\"
 }}
-""")
+"""
+
+# langchain is slow to import, so the templates, the chat model and the result cache are created on first use
+ChatPromptTemplate = None
+SYSTEM_MSG_TEMPLATE = None
+HUMAN_MSG_TEMPLATE = None
+PACKED_MSG_TEMPLATE = None
+AI_MSG_TEMPLATE = None
+chat = None
+result_cache = None
+chat_loaded = False
+chat_lock = threading.Lock()
+
+def load_chat():
+    global ChatPromptTemplate, SYSTEM_MSG_TEMPLATE, HUMAN_MSG_TEMPLATE, PACKED_MSG_TEMPLATE, AI_MSG_TEMPLATE, chat, result_cache, chat_loaded
+    with chat_lock:
+        if chat_loaded:
+            return
+        from langchain.chat_models import AzureChatOpenAI
+        from langchain.prompts import (
+            ChatPromptTemplate,
+            SystemMessagePromptTemplate,
+            AIMessagePromptTemplate,
+            HumanMessagePromptTemplate,
+        )
+
+        # The chat model reads the service settings from the environment
+        os.environ["OPENAI_API_TYPE"] = "azure"
+        os.environ["OPENAI_API_VERSION"] = require('openai', 'openai_api_version')
+        os.environ["OPENAI_API_BASE"] = require('openai', 'openai_api_base')
+        os.environ["OPENAI_API_KEY"] = require('openai', 'openai_api_key')
 
-# Create an instance of Azure OpenAI chat model
-chat = AzureChatOpenAI(
-    deployment_name="gpt-35-turbo",
-    openai_api_version="2023-05-15"
-)
+        SYSTEM_MSG_TEMPLATE = SystemMessagePromptTemplate.from_template(SYSTEM_MSG)
+        HUMAN_MSG_TEMPLATE = HumanMessagePromptTemplate.from_template(HUMAN_MSG)
+        PACKED_MSG_TEMPLATE = HumanMessagePromptTemplate.from_template(PACKED_MSG)
+        AI_MSG_TEMPLATE = AIMessagePromptTemplate.from_template(AI_MSG)
+
+        # Create an instance of Azure OpenAI chat model
+        chat = AzureChatOpenAI(
+            deployment_name="gpt-35-turbo",
+            openai_api_version="2023-05-15"
+        )
+
+        # Persistent cache of evaluations, the chat model runs at temperature 0 so results are reusable
+        result_cache = ResultCache(result_cache_path, result_cache_max_entries, result_cache_ttl_seconds) if result_cache_enabled else None
+        chat_loaded = True
 
 def get_system_message(commitment, policy):
     chat_prompt = ChatPromptTemplate.from_messages([SYSTEM_MSG_TEMPLATE])
@@ -75,9 +120,147 @@ def get_human_message(snippet, messages):
     messages.extend(human_prompt_value.to_messages())
     return messages
 
-def evaluate_snippet(commitment, policy, examples, snippet):
+# Prebuilt system and example messages per commitment, with their estimated token count
+prompt_prefix_cache = {}
+prompt_prefix_lock = threading.Lock()
+
+def get_prompt_prefix(commitment, policy, examples):
+    load_chat()
+    # The cached prefix is reused while the same policy and examples object are passed in,
+    # a reloaded examples document is a new object and rebuilds the prefix
+    with prompt_prefix_lock:
+        cached = prompt_prefix_cache.get(commitment)
+        if cached is not None and cached["policy"] == policy and cached["examples"] is examples:
+            return cached
+
     messages = get_system_message(commitment, policy)
     messages = get_example_messages(examples, messages)
-    messages = get_human_message(snippet, messages)
-    response = chat(messages)
-    return response.content
+    tokens = sum(estimate_token_count(message.content) for message in messages)
+    # Fingerprint of everything in the prompt except the snippet, used by the result cache
+    fingerprint = ResultCache.make_key(chat.deployment_name, commitment, policy, json.dumps(examples, sort_keys=True))
+    cached = {"policy": policy, "examples": examples, "messages": messages, "tokens": tokens, "fingerprint": fingerprint}
+    with prompt_prefix_lock:
+        prompt_prefix_cache[commitment] = cached
+    return cached
+
+def generate(messages):
+    # Send one chat request through langchain and return the answer text. The request is recorded in the run
+    # metrics like the requests of utils.client, with the HTTP status of a failed request when the error has one.
+    # Retries happen inside langchain, so they are not counted
+    request_bytes = sum(len(message.content.encode("utf-8")) for message in messages)
+    start = time.perf_counter()
+    try:
+        result = chat.generate([messages])
+    except Exception as e:
+        metrics.record_request("chat", getattr(e, "http_status", None), time.perf_counter() - start, 0, request_bytes)
+        raise
+    content = result.generations[0][0].text
+    metrics.record_request("chat", 200, time.perf_counter() - start, 0, request_bytes, len(content.encode("utf-8")))
+    metrics.record_usage("chat", (result.llm_output or {}).get("token_usage"))
+    return content
+
+def evaluate_snippet(commitment, policy, examples, snippet, lookup_cache=True):
+    prefix = get_prompt_prefix(commitment, policy, examples)
+
+    # Return the cached evaluation if this snippet was evaluated with the same prompt before,
+    # lookup_cache is False when the caller already missed the cache for it
+    if result_cache is not None:
+        key = ResultCache.make_key(prefix["fingerprint"], snippet)
+        cached_result = result_cache.get(key) if lookup_cache else None
+        if lookup_cache:
+            record_cache_lookups(1, 0 if cached_result is not None else 1)
+        if cached_result is not None:
+            return cached_result
+
+    human_message = HUMAN_MSG_TEMPLATE.format(snippet=snippet)
+    messages = prefix["messages"] + [human_message]
+    # Stay within the client-side chat quota shared with utils.openai
+    chat_rate_limiter.acquire(prefix["tokens"] + estimate_token_count(human_message.content))
+    content = generate(messages)
+
+    if result_cache is not None:
+        result_cache.put(key, content)
+    return content
+
+def parse_packed_verdicts(content, ids):
+    # Return {id: verdict JSON} for the well-formed entries of a packed response, anything else is left out
+    try:
+        items = json.loads(content)
+    except json.JSONDecodeError:
+        # Tolerate text around the array
+        start, end = content.find("["), content.rfind("]")
+        try:
+            items = json.loads(content[start:end + 1]) if start != -1 and end > start else None
+        except json.JSONDecodeError:
+            items = None
+    if not isinstance(items, list):
+        return {}
+
+    verdicts = {}
+    for item in items:
+        # A JSON true would otherwise match id 1, as True == 1
+        if not isinstance(item, dict) or type(item.get("id")) is not int or item["id"] not in ids or item["id"] in verdicts:
+            continue
+        verdict = {}
+        for field, values in VERDICT_VALUES.items():
+            value = item.get(field)
+            if isinstance(value, str) and value.upper() in values:
+                verdict[field] = value.upper()
+        if len(verdict) < len(VERDICT_VALUES) or not isinstance(item.get("reason"), str):
+            continue
+        verdict["reason"] = item["reason"]
+        verdicts[item["id"]] = json.dumps(verdict)
+    return verdicts
+
+def evaluate_packed(prefix, snippets):
+    # Classify the snippets in one chat request, returning the verdict JSON per position or None when it is missing or malformed
+    packed = json.dumps([{"id": id, "snippet": snippet} for id, snippet in enumerate(snippets, 1)])
+    packed_message = PACKED_MSG_TEMPLATE.format(snippets=packed)
+    messages = prefix["messages"] + [packed_message]
+    chat_rate_limiter.acquire(prefix["tokens"] + estimate_token_count(packed_message.content))
+    verdicts = parse_packed_verdicts(generate(messages), range(1, len(snippets) + 1))
+    return [verdicts.get(id) for id in range(1, len(snippets) + 1)]
+
+def evaluate_snippets(commitment, policy, examples, snippets, token_counts=None, pack_size=chat_pack_size):
+    # Evaluate several snippets of the same commitment, sending up to pack_size of them per chat request,
+    # token_counts holds the known token count of each snippet for sizing the packs.
+    # The results are in the format of evaluate_snippet, snippets left out of a packed response are evaluated on their own
+    prefix = get_prompt_prefix(commitment, policy, examples)
+    contents = [None] * len(snippets)
+
+    # Only the snippets not in the result cache are sent
+    keys = [ResultCache.make_key(prefix["fingerprint"], snippet) for snippet in snippets]
+    if result_cache is not None:
+        for position, key in enumerate(keys):
+            contents[position] = result_cache.get(key)
+    missing = [position for position, content in enumerate(contents) if content is None]
+    if result_cache is not None:
+        record_cache_lookups(len(snippets) - len(missing), len(missing))
+
+    if pack_size > 1:
+        missing_token_counts = [token_counts[position] for position in missing] if token_counts is not None else None
+        for batch in batch_inputs([snippets[position] for position in missing], pack_size, chat_pack_token_limit, missing_token_counts):
+            batch = [missing[position] for position in batch]
+            if len(batch) < 2:
+                continue
+            verdicts = evaluate_packed(prefix, [snippets[position] for position in batch])
+            fallbacks = 0
+            for position, verdict in zip(batch, verdicts):
+                if verdict is None:
+                    fallbacks += 1
+                    continue
+                contents[position] = verdict
+                if result_cache is not None:
+                    result_cache.put(keys[position], verdict)
+            metrics.record_usage("chat_packing", {"requests": 1, "snippets": len(batch), "fallbacks": fallbacks})
+
+    # Fall back to one request per snippet for anything the packed requests did not answer,
+    # these snippets were already looked up in the result cache above
+    for position, content in enumerate(contents):
+        if content is None:
+            contents[position] = evaluate_snippet(commitment, policy, examples, snippets[position], lookup_cache=False)
+    return contents
+
+def record_cache_lookups(hits, misses):
+    # The result cache counts its hits and misses since the process started, a run's own are in its metrics
+    metrics.record_usage("result_cache", {"hits": hits, "misses": misses})
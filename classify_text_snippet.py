@@ -1,60 +1,83 @@
 import argparse
 import json
-from tabulate import tabulate
-from utils.openai import generate_chat_completion
+from concurrent.futures import ThreadPoolExecutor
 
 # Parse command line arguments
 parser = argparse.ArgumentParser()
-parser.add_argument("--snippet", help="the new snippet of text to classify", required=True)
+group = parser.add_mutually_exclusive_group(required=True)
+group.add_argument("--snippet", help="the new snippet of text to classify")
+group.add_argument("--input", help="a JSON Lines file of records with a \"snippet\" field to classify in batch")
+parser.add_argument("--output", help="the JSON Lines file to append the batch results to (required with --input)")
+parser.add_argument("--offset", type=int, help="the number of input records to skip, defaults to resuming after the records already in --output")
+parser.add_argument("--batch-size", type=int, default=64, help="the number of records held in memory at a time")
+parser.add_argument("--workers", type=int, default=8, help="the number of concurrent chat requests")
 args = parser.parse_args()
+if args.input and not args.output:
+    parser.error("--output is required with --input")
+
+# Import the service clients once the arguments are valid, so --help and usage errors return immediately
+from utils.openai import generate_chat_completion
+from utils.batch import run_batch
 
 # Load the message template
 with open("messages/fitness.json", "r") as f:
-    messages = json.load(f)
-
-# Define the new dictionary to append to the list of dictionaries
-new_dict = {"role": "user", "content": args.snippet}
-
-# Append the new dictionary to the list of dictionaries in the message template
-messages.append(new_dict)
+    template_messages = json.load(f)
 
-# Generate the chat completion using the message template
-chat_response = generate_chat_completion(messages)
+def classify_snippet(snippet):
+    # Append the snippet to a copy of the message template and generate the chat completion
+    messages = template_messages + [{"role": "user", "content": snippet}]
+    chat_response = generate_chat_completion(messages)
 
-try:
-    # Try to access the "content" key in the expected dictionary structure
-    content = chat_response["choices"][0]["message"]["content"]
-except (KeyError, IndexError):
-    # Handle the case where neither dictionary structure is valid
-    content = None
-    print("Error: could not extract content from chat response")
+    try:
+        # Try to access the "content" key in the expected dictionary structure
+        content = chat_response["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        # Handle the case where neither dictionary structure is valid
+        return None, None, "Error: could not extract content from chat response"
 
-if content is not None:
     try:
         # Attempt to parse the JSON-formatted text into a Python dictionary
-        data = json.loads(content)
+        return content, json.loads(content), None
     except json.JSONDecodeError:
         # Handle the case where the content is not valid JSON
-        data = None
-        print("Error: content is not valid JSON")
-        print(content)
+        return content, None, "Error: content is not valid JSON"
+
+def classify_group(records):
+    # Classify the records of the group concurrently, keeping their order
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        classifications = list(executor.map(lambda record: classify_snippet(record["snippet"]), records))
+    return [
+        dict(record, result=data, content=content, error=error)
+        for record, (content, data, error) in zip(records, classifications)
+    ]
+
+if args.input:
+    run_batch(args.input, args.output, classify_group, args.batch_size, args.offset)
+else:
+    from tabulate import tabulate
+
+    content, data, error = classify_snippet(args.snippet)
+    if error is not None:
+        print(error)
+        if content is not None:
+            print(content)
 
-if data is not None:
-    # Truncate the "reason" column to a maximum of 150 characters
-    data ["reason"] = (data ["reason"] [:150] + '..') if len (data ["reason"]) > 50 else data ["reason"]
+    if data is not None:
+        # Truncate the "reason" column to a maximum of 150 characters
+        data ["reason"] = (data ["reason"] [:150] + '..') if len (data ["reason"]) > 50 else data ["reason"]
 
-    # Extract the keys from the dictionary
-    keys = list(data.keys())
+        # Extract the keys from the dictionary
+        keys = list(data.keys())
 
-    # Extract the values from the dictionary
-    values = list(data.values())
+        # Extract the values from the dictionary
+        values = list(data.values())
 
-    # Format the values as a list of lists
-    table_data = [values]
+        # Format the values as a list of lists
+        table_data = [values]
 
-    # Format the list of lists as a table using the tabulate library
-    table_str = tabulate(table_data, headers=keys)
+        # Format the list of lists as a table using the tabulate library
+        table_str = tabulate(table_data, headers=keys)
 
-    # Print the table
-    print("\n")
-    print(table_str)
+        # Print the table
+        print("\n")
+        print(table_str)
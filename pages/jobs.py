@@ -0,0 +1,71 @@
+import time
+import streamlit as st
+import pandas as pd
+from chat import chat_pack_size
+from pipeline import MAX_WORKERS
+from utils.jobs import get_job_queue, job_poll_seconds, QUEUED, RUNNING, DONE, FAILED
+
+# st.experimental_rerun was renamed to st.rerun in later Streamlit releases
+rerun = getattr(st, "rerun", None) or st.experimental_rerun
+
+def main():
+    # Heading
+    st.title("Classification Jobs")
+    st.caption("Queued documents are classified by the worker processes started with `python worker.py`.")
+    queue = get_job_queue()
+
+    # Queue one job per uploaded file, the form is cleared so that a rerun does not queue them again
+    with st.form("submit_jobs", clear_on_submit=True):
+        uploaded_files = st.file_uploader("Choose PDF files", type="pdf", accept_multiple_files=True)
+        max_workers = st.number_input("Concurrent workers per document", min_value=1, max_value=32, value=MAX_WORKERS)
+        deduplicate = st.checkbox("Deduplicate near-identical chunks", value=True)
+        pack_size = st.number_input("Snippets per chat request", min_value=1, max_value=32, value=chat_pack_size)
+        submitted = st.form_submit_button("Queue documents")
+    if submitted and uploaded_files:
+        options = {"max_workers": max_workers, "deduplicate": deduplicate, "pack_size": pack_size}
+        for uploaded_file in uploaded_files:
+            queue.submit(uploaded_file.name, uploaded_file.getvalue(), options)
+        st.success(f"Queued {len(uploaded_files)} documents.")
+
+    jobs = queue.list()
+    if not jobs:
+        st.info("No jobs yet.")
+        return
+
+    # Status of all jobs
+    st.dataframe(pd.DataFrame([
+        {
+            "job": job["id"],
+            "document": job["name"],
+            "status": job["status"],
+            "pages": f"{job['pages_read']} of {job['pages']}" if job["pages"] else "",
+            "chunks": job["chunks_done"],
+            "updated": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(job["updated"])),
+        }
+        for job in jobs
+    ]), hide_index=True)
+
+    # Results of finished jobs and errors of failed ones
+    for job in jobs:
+        if job["status"] == DONE:
+            with st.expander(f"{job['name']} (job {job['id']})"):
+                df = pd.DataFrame(sorted(queue.rows(job["id"]).values(), key=lambda row: row["chunk_number"]))
+                st.download_button("Download CSV", df.to_csv(index=False), file_name=f"{job['id']}-chunks.csv", mime="text/csv", key=f"csv-{job['id']}")
+                with open(queue.file_path(job["id"], "annotated.pdf"), "rb") as f:
+                    st.download_button("Download Annotated PDF", f.read(), file_name=f"{job['id']}-annotated.pdf", mime="application/pdf", key=f"pdf-{job['id']}")
+                if job["unmatched"]:
+                    st.caption(f"{job['unmatched']} flagged snippets could not be located in the PDF.")
+        elif job["status"] == FAILED:
+            with st.expander(f"{job['name']} (job {job['id']}) failed"):
+                st.code(job["error"])
+                if st.button("Retry", key=f"retry-{job['id']}"):
+                    queue.retry(job["id"])
+                    rerun()
+
+    # Poll while any job is still queued or running
+    if any(job["status"] in (QUEUED, RUNNING) for job in jobs):
+        time.sleep(job_poll_seconds)
+        rerun()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+import io
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from utils.search import query_search_index
+from utils.annotation import annotate_document
+from utils.batch import iter_groups
+from utils.dedup import NearDuplicateIndex
+from utils.metrics import metrics, bind_metrics
+from utils.vote import fast_path_enabled, fast_path_neighbors, fast_path_min_margin, fast_path_verdict, rank_categories
+from utils.openai import generate_query_embedding, generate_query_embeddings, embedding_batch_size
+from chat import evaluate_snippet, evaluate_snippets, chat_pack_size
+
+# Configuration variables
+FILE_TYPE_PDF = "pdf"
+MAX_WORKERS = 8
+
+# Parsed messages/examples.json, shared by all chunks
+examples_doc_cache = None
+examples_doc_lock = threading.Lock()
+
+def annotate_pdf(file_data, rows):
+    import fitz
+
+    # Open the PDF from memory
+    doc = fitz.open(stream=file_data, filetype=FILE_TYPE_PDF)
+
+    # Highlight every flagged snippet on its own page (page_number in the rows is 1-based)
+    snippets = [(row["page_number"] - 1, row["snippet"]) for row in rows if is_flagged(row["is_special_commitment"])]
+    unmatched = annotate_document(doc, snippets)
+
+    # Save the annotated PDF to memory and return its bytes with the number of snippets that could not be located
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    doc.close()
+    return buffer.getvalue(), unmatched
+
+def is_flagged(is_special_commitment):
+    # The evaluation returns the string "TRUE" or "FALSE", which must not be treated as truthy
+    if isinstance(is_special_commitment, str):
+        return is_special_commitment.upper() == "TRUE"
+    return bool(is_special_commitment)
+
+def process_chunks(chunks, max_workers=MAX_WORKERS, on_progress=None, deduplicate=True, pack_size=chat_pack_size, done_rows=None, on_row=None):
+    # Process the chunks on a bounded thread pool, the work is dominated by network round trips
+    # Chunks are consumed as they are produced, so classification starts while later pages are still being parsed.
+    # Chunks with a row in done_rows ({chunk_number: row}, from a checkpoint) are not processed again unless the
+    # chunk text changed, on_row(row) is called for every newly finished row
+    rows = {}
+    futures = {}
+    pending = set()
+    # Near-duplicate chunks wait for their representative's row instead of being processed
+    duplicate_index = NearDuplicateIndex()
+    duplicates = {}
+    # With packing, retrieved chunks that need the chat model wait per candidate commitment until a pack is full
+    packs = {}
+    retrieving = 0
+    resumed = set()
+    submitted = 0
+    completed = 0
+
+    def complete(i, row):
+        # Progress is reported from this thread as chunks finish, Streamlit calls must not run on the workers
+        nonlocal completed
+        rows[i] = row
+        completed += 1
+        if on_row is not None and i not in resumed:
+            on_row(row)
+        if on_progress is not None:
+            on_progress(completed, submitted)
+
+    def submit_pack(commitment):
+        future = executor.submit(bind_metrics(timed_classify_pack), commitment, packs.pop(commitment), pack_size)
+        futures[future] = "classify"
+        pending.add(future)
+
+    def collect(done):
+        nonlocal retrieving
+        for future in done:
+            if futures.pop(future) == "retrieve":
+                retrieving -= 1
+                row, candidates = future.result()
+                if candidates:
+                    # Wait for more chunks of the same commitment
+                    packs.setdefault(candidates[0], []).append((row, candidates))
+                    if len(packs[candidates[0]]) >= pack_size:
+                        submit_pack(candidates[0])
+                    continue
+                finished = [row]
+            else:
+                finished = future.result()
+            for row in finished:
+                i = row["chunk_number"]
+                complete(i, row)
+                for j, chunk in duplicates.pop(i, []):
+                    complete(j, copy_row(rows[i], j, chunk))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for group in iter_groups(chunks, embedding_batch_size):
+            representatives = []
+            for chunk in group:
+                i = submitted
+                submitted += 1
+                representative = duplicate_index.find_or_add(chunk["chunk"], i) if deduplicate else None
+                if done_rows and i in done_rows and done_rows[i]["snippet"] == chunk["chunk"]:
+                    resumed.add(i)
+                    complete(i, done_rows[i])
+                elif representative is None:
+                    representatives.append((i, chunk))
+                elif representative in rows:
+                    complete(i, copy_row(rows[representative], i, chunk))
+                else:
+                    duplicates.setdefault(representative, []).append((i, chunk))
+
+            # Generate the embeddings for the representatives of the group in one batched request
+            with metrics.timed("embedding"):
+                embeddings = generate_query_embeddings([chunk["chunk"] for _, chunk in representatives], [chunk["tokens"] for _, chunk in representatives])
+            for (i, chunk), embedding in zip(representatives, embeddings):
+                future = executor.submit(bind_metrics(timed_process_chunk), i, chunk, embedding, pack_size > 1)
+                futures[future] = "retrieve"
+                pending.add(future)
+                retrieving += 1
+
+            # Report finished chunks and apply backpressure to the parser when too many are in flight
+            done, pending = wait(pending, timeout=0)
+            collect(done)
+            while len(pending) > 2 * max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+
+        while pending or packs:
+            # Once every chunk is retrieved, the partly filled packs are sent as they are
+            if retrieving == 0:
+                for commitment in list(packs):
+                    submit_pack(commitment)
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+
+    # Keep the rows in chunk order regardless of completion order
+    return [rows[i] for i in range(len(rows))]
+
+def timed_process_chunk(i, chunk, embedding=None, defer_chat=False):
+    with metrics.timed("process_chunk"):
+        if defer_chat:
+            return retrieve_chunk(i, chunk, embedding)
+        return process_chunk(i, chunk, embedding), []
+
+def timed_classify_pack(commitment, pack, pack_size=chat_pack_size):
+    with metrics.timed("classify_pack"):
+        return classify_pack(commitment, pack, pack_size)
+
+def copy_row(row, i, chunk):
+    # Fan a representative's classification out to a near-duplicate chunk
+    return dict(
+        row,
+        chunk_number=i,
+        page_number=chunk["page_number"]+1,
+        snippet=chunk["chunk"],
+        tokens=chunk["tokens"],
+        duplicate_of=row["chunk_number"],
+    )
+
+def process_chunk(i, chunk, embedding=None):
+    row, candidates = retrieve_chunk(i, chunk, embedding)
+    return classify_chunk(row, candidates)
+
+def retrieve_chunk(i, chunk, embedding=None):
+    # Return the chunk's row and the candidate commitments it still has to be evaluated against by the chat model
+
+    # 1. OpenAI - Generate the query embedding (unless it was already generated in a batch)
+    snippet = chunk["chunk"]
+    if embedding is None:
+        with metrics.timed("embedding"):
+            embedding = generate_query_embedding(snippet)
+
+    # 2. Cognitive Search - Query the search index, the fast path votes over several neighbours
+    number_of_nearest_neighbors = fast_path_neighbors if fast_path_enabled else 1
+    with metrics.timed("search"):
+        query_results = query_search_index(embedding, number_of_nearest_neighbors) if embedding is not None else {"value": []}
+    results = query_results["value"]
+    verdict = fast_path_verdict(results) if fast_path_enabled else None
+
+    # Display the chunk
+    row = {
+        "chunk_number": i,
+        "page_number": chunk["page_number"]+1,
+        "snippet": snippet,
+        "tokens": chunk["tokens"],
+        "commitment": None,
+        "is_special_commitment": None,
+        "confidence": None,
+        "reason": None,
+        "eval": None,
+        "duplicate_of": None
+    }
+
+    # Leave the chunk unclassified if the embedding or search failed after retries
+    if not results:
+        return row, []
+    if verdict is not None:
+        # Retrieval is decisive, return the neighbours' verdict without asking the chat model
+        row["commitment"] = verdict["category"]
+        row["is_special_commitment"] = verdict["is_special_commitment"]
+        row["confidence"] = "HIGH"
+        row["reason"] = "Nearest-neighbour vote (top score {:.3f}, margin {:.2f}).".format(verdict["score"], verdict["margin"])
+        row["eval"] = dict(verdict, fast_path=True)
+        return row, []
+
+    # Ambiguous chunks are evaluated against the top category, and against the runner-up
+    # when the category vote is close and the top category is not flagged
+    candidates, margin = rank_categories(results)
+    if fast_path_enabled and margin < fast_path_min_margin:
+        return row, candidates[:2]
+    return row, candidates[:1]
+
+def set_eval(row, commitment, eval):
+    is_special_commitment, confidence, reason, eval = unpack_eval(eval)
+    row.update(commitment=commitment, is_special_commitment=is_special_commitment, confidence=confidence, reason=reason, eval=eval)
+
+def classify_chunk(row, candidates):
+    for commitment in candidates:
+        # Get the policy and examples for the commitment
+        examples_doc = get_examples_doc()
+        policy = examples_doc[commitment]["policy"]
+        examples = examples_doc[commitment]["examples"]
+
+        # 3. OpenAI - Evaluate the snippet
+        with metrics.timed("chat"):
+            eval = evaluate_snippet(commitment, policy, examples, row["snippet"])
+        set_eval(row, commitment, eval)
+        if is_flagged(row["is_special_commitment"]):
+            break
+    return row
+
+def classify_pack(commitment, pack, pack_size=chat_pack_size):
+    # Evaluate the snippets of several chunks against their top commitment in packed chat requests of up to pack_size snippets,
+    # chunks that are not flagged and have a runner-up commitment are then evaluated against it on their own
+    examples_doc = get_examples_doc()
+    policy = examples_doc[commitment]["policy"]
+    examples = examples_doc[commitment]["examples"]
+    with metrics.timed("chat"):
+        evals = evaluate_snippets(commitment, policy, examples, [row["snippet"] for row, _ in pack], [row["tokens"] for row, _ in pack], pack_size)
+
+    rows = []
+    for (row, candidates), eval in zip(pack, evals):
+        set_eval(row, commitment, eval)
+        if not is_flagged(row["is_special_commitment"]):
+            row = classify_chunk(row, candidates[1:])
+        rows.append(row)
+    return rows
+
+def unpack_eval(eval):
+    if isinstance(eval, str):
+        try:
+            eval = json.loads(eval)
+        except json.JSONDecodeError:
+            return None, None, None, eval
+
+    is_special_commitment = eval.get("is_special_commitment")
+    if isinstance(is_special_commitment, str):
+        is_special_commitment = is_special_commitment.upper()
+
+    confidence = eval.get("confidence")
+    if isinstance(confidence, str):
+        confidence = confidence.upper()
+
+    reason = eval.get("reason")
+
+    return is_special_commitment, confidence, reason, eval
+
+def get_examples_doc():
+    # Load the examples from from messages/examples.json and return the dictionary
+    # The parsed document is reused until the file's modification time changes
+    global examples_doc_cache
+    path = os.path.join(os.path.dirname(__file__), "messages", "examples.json")
+    mtime = os.path.getmtime(path)
+    with examples_doc_lock:
+        if examples_doc_cache is None or examples_doc_cache["mtime"] != mtime:
+            with open(path, "r") as f:
+                examples_doc_cache = {"mtime": mtime, "examples": json.load(f)}
+        return examples_doc_cache["examples"]
@@ -1,39 +1,139 @@
+import argparse
 import json
-from utils.search import create_search_index, delete_search_index, upload_documents_to_search_index
-from utils.openai import generate_query_embedding
+import os
 
-try:
-    # 1. Drop search index if it exists
-    delete_search_index()
+# Parse command line arguments
+parser = argparse.ArgumentParser()
+parser.add_argument("--sync", action="store_true", help="only embed and upload added or changed documents and delete removed ones, instead of rebuilding the index")
+args = parser.parse_args()
 
-    # 2. Create search index
-    create_search_index()
+# Import the service clients once the arguments are valid, so --help and usage errors return immediately
+from utils.search import create_search_index, delete_search_index, get_search_index_fields, upload_documents_to_search_index, delete_documents_from_search_index, save_local_index, sync_local_index, search_backend, index_name, local_index_path, manifest_path, embedding_store_path, embedding_store_dtype
+from utils.openai import generate_query_embeddings
+from utils.manifest import document_id, get_label, load_manifest, save_manifest, diff_manifest
+from utils.embedding_store import EmbeddingStore, EmbeddingStoreWriter
+from utils.batch import iter_groups
 
-    # 3. Generate embeddings
-    with open('data/documents.json', 'r') as f:
-        documents = json.load(f)
+# Define the ANSI escape codes for coloured text
+ORANGE = "\033[38;5;208m"
+RESET = "\033[0m"
+
+def build_search_documents(documents, current_documents):
+    # Generate the embeddings and convert the documents to the search upload format.
+    # Vectors already in the embedding store are reused, and the store is rewritten with the vectors
+    # of current_documents (all documents in documents.json) only
+    previous_store = EmbeddingStore.load(embedding_store_path) if EmbeddingStore.exists(embedding_store_path) else None
+    contents = {document_id(document): document["content"] for document in documents}
+    missing = [id for id in contents if previous_store is None or id not in previous_store]
+
+    print(f"Generatting embeddings for {len(missing)} documents ({len(contents) - len(missing)} reused from the embedding store)...")
+    # The new embeddings are written to a staging store group by group, in the configured type
+    staging_path = embedding_store_path + ".staging"
+    staging = EmbeddingStoreWriter(staging_path, len(missing), embedding_store_dtype)
+    for group in iter_groups(missing, 1024):
+        embeddings = generate_query_embeddings([contents[id] for id in group])
+        for id, embedding in zip(group, embeddings):
+            if embedding is not None:
+                staging.add(id, embedding)
+    new_store = staging.close()
+    print(f" - {len(new_store)} of {len(missing)} embeddings generated.")
 
-    embeddings = []
-    print("Generatting embeddings...")
-    for i, document in enumerate(documents):
-        embedding = generate_query_embedding(document["content"])
-        embeddings.append(embedding)
-        print(f" - Embedding {i+1} of {len(documents)} generated.")
+    def get_vector(id):
+        # Quantizing a dequantized vector again gives back the same values
+        if id in new_store:
+            return new_store.vector(new_store.rows[id])
+        return previous_store.vector(previous_store.rows[id])
+
+    current_ids = dict.fromkeys(document_id(document) for document in current_documents)
+    ids = [id for id in current_ids if id in new_store or (previous_store is not None and id in previous_store)]
+    if not ids:
+        EmbeddingStore.remove(staging_path)
+        return []
+    dimensions = new_store.dimensions if len(new_store) else previous_store.dimensions
+    store = EmbeddingStore.write(embedding_store_path, ids, get_vector, dimensions, embedding_store_dtype)
+    EmbeddingStore.remove(staging_path)
 
-    # 4. Upload documents to search index
     data = []
     for i in range(len(documents)):
+        id = document_id(documents[i])
+        if id not in store:
+            continue
         document = {
-            "id": str(i+1),
+            "id": id,
             "content": documents[i]["content"],
             "category": documents[i]["category"],
-            "contentVector": embeddings[i]
+            "isSpecialCommitment": get_label(documents[i]),
+            "contentVector": store.get(id)
         }
         data.append(document)
-    payload = {
-        "value": data
-    }
-    upload_documents_to_search_index(payload)
+    return data
+
+try:
+    with open('data/documents.json', 'r') as f:
+        documents = json.load(f)
+
+    # An index that cannot be synced is rebuilt instead
+    sync = args.sync
+    if sync:
+        if search_backend == "local":
+            index_exists = os.path.exists(local_index_path)
+            # The local index searches the vectors of the embedding store, an index built before the store existed has its own
+            if index_exists and not EmbeddingStore.exists(embedding_store_path):
+                print(f"No embedding store {ORANGE}{embedding_store_path}{RESET} for the local index, rebuilding it instead of syncing.")
+                sync = False
+        else:
+            index_fields = get_search_index_fields()
+            index_exists = index_fields is not None
+            if index_exists and "isSpecialCommitment" not in index_fields:
+                print(f"Index {ORANGE}{index_name}{RESET} has no isSpecialCommitment field, rebuilding it instead of syncing.")
+                sync = False
+            elif not index_exists:
+                create_search_index()
+        # Without a manifest the ids of the documents in an existing index are unknown, e.g. an index built
+        # before manifests were kept, and syncing would add a second copy of every document
+        if sync and index_exists and not os.path.exists(manifest_path):
+            print(f"No manifest {ORANGE}{manifest_path}{RESET} for the existing index, rebuilding it instead of syncing.")
+            sync = False
+
+    if sync:
+        # 1. Diff the documents against the manifest of the current index
+        manifest = load_manifest(manifest_path) if index_exists else {}
+        added, removed = diff_manifest(manifest, documents)
+        print(f"{len(added)} documents to add, {len(removed)} documents to remove, {len(documents) - len(added)} unchanged.")
+
+        # 2. Embed and upload the added documents, delete the removed ones
+        data = build_search_documents(added, documents) if added else []
+        if search_backend == "local":
+            sync_local_index(data, removed)
+        else:
+            if data:
+                upload_documents_to_search_index({"value": [dict(document, **{"@search.action": "mergeOrUpload"}) for document in data]})
+            if removed:
+                delete_documents_from_search_index(removed)
+    else:
+        if search_backend != "local":
+            # 1. Drop search index if it exists
+            delete_search_index()
+
+            # 2. Create search index
+            create_search_index()
+
+        # 3. Generate embeddings
+        data = build_search_documents(documents, documents)
+
+        # 4. Upload documents to search index
+        if search_backend == "local":
+            save_local_index(data)
+        else:
+            payload = {
+                "value": data
+            }
+            upload_documents_to_search_index(payload)
+
+    # Record the documents now in the index for the next sync, documents whose embedding failed are retried then
+    uploaded_ids = {document["id"] for document in data}
+    failed_ids = {document_id(document) for document in (added if sync else documents)} - uploaded_ids
+    save_manifest(manifest_path, [document for document in documents if document_id(document) not in failed_ids])
 
 except Exception as e:
     print(f"Error: {e}")
@@ -1,8 +1,5 @@
 import argparse
 import json
-from tabulate import tabulate
-from utils.search import query_search_index
-from utils.openai import generate_query_embedding
 
 # Define the ANSI escape codes for coloured text
 ORANGE = "\033[38;5;208m"
@@ -10,19 +7,30 @@ RESET = "\033[0m"
 
 # Parse command line arguments
 parser = argparse.ArgumentParser()
-parser.add_argument("--query", help="the search query", required=True)
+group = parser.add_mutually_exclusive_group(required=True)
+group.add_argument("--query", help="the search query")
+group.add_argument("--input", help="a JSON Lines file of records with a \"query\" field to search in batch")
+parser.add_argument("--output", help="the JSON Lines file to append the batch results to (required with --input)")
+parser.add_argument("--offset", type=int, help="the number of input records to skip, defaults to resuming after the records already in --output")
+parser.add_argument("--batch-size", type=int, default=64, help="the number of records embedded and searched together")
+parser.add_argument("--workers", type=int, default=8, help="the number of concurrent search requests")
 parser.add_argument("-n", "--num-neighbors", type=int, default=3, help="the number of nearest neighbors to retrieve")
 args = parser.parse_args()
+if args.input and not args.output:
+    parser.error("--output is required with --input")
+
+# Import the service clients once the arguments are valid, so --help and usage errors return immediately
+from utils.search import query_search_index, query_search_index_batch
+from utils.openai import generate_query_embedding, generate_query_embeddings
+from utils.batch import run_batch
 
-# Define the search query
-query = args.query
 number_of_nearest_neighbors = args.num_neighbors
-print(f"\nLooking for the {ORANGE}{number_of_nearest_neighbors}{RESET} nearest neighbors of '{ORANGE}{query}{RESET}' in the vector space...\n")
 
-# Generate the query embedding
-embedding = generate_query_embedding(query)
-results = query_search_index(embedding, number_of_nearest_neighbors)["value"]
-print(json.dumps(results, indent=4))
+def search_group(records):
+    # Embed the group in batched requests, then search for every record concurrently
+    embeddings = generate_query_embeddings([record["query"] for record in records])
+    results = query_search_index_batch(embeddings, number_of_nearest_neighbors, args.workers)
+    return [dict(record, results=result["value"]) for record, result in zip(records, results)]
 
 # Define a custom formatting function to truncate the text in the "content" column
 def truncate_title(text):
@@ -32,9 +40,24 @@ def truncate_title(text):
     else:
         return text
 
-# Apply the custom formatting function to the "content" column
-for result in results:
-    result["content"] = truncate_title(result["content"])
+if args.input:
+    print(f"\nLooking for the {ORANGE}{number_of_nearest_neighbors}{RESET} nearest neighbors of the queries in '{ORANGE}{args.input}{RESET}'...\n")
+    run_batch(args.input, args.output, search_group, args.batch_size, args.offset)
+else:
+    from tabulate import tabulate
+
+    # Define the search query
+    query = args.query
+    print(f"\nLooking for the {ORANGE}{number_of_nearest_neighbors}{RESET} nearest neighbors of '{ORANGE}{query}{RESET}' in the vector space...\n")
+
+    # Generate the query embedding
+    embedding = generate_query_embedding(query)
+    results = query_search_index(embedding, number_of_nearest_neighbors)["value"]
+    print(json.dumps(results, indent=4))
+
+    # Apply the custom formatting function to the "content" column
+    for result in results:
+        result["content"] = truncate_title(result["content"])
 
-# Print the results in a tabulated format
-print(tabulate(results, headers="keys", tablefmt="grid"))
+    # Print the results in a tabulated format
+    print(tabulate(results, headers="keys", tablefmt="grid"))
@@ -0,0 +1,115 @@
+import re
+from difflib import SequenceMatcher
+
+# Minimum share of snippet words a fuzzy match must cover, and the shortest run of words worth highlighting
+FUZZY_MATCH_THRESHOLD = 0.6
+FUZZY_MINIMUM_BLOCK = 3
+
+class PageWordIndex:
+    """Words and positions of one PDF page, extracted once, with an index from word to positions."""
+
+    def __init__(self, page):
+        # Each word is (x0, y0, x1, y1, text, block_no, line_no, word_no)
+        self.words = page.get_text("words")
+        self.tokens = [normalize_word(word[4]) for word in self.words]
+        self.positions = {}
+        for position, token in enumerate(self.tokens):
+            self.positions.setdefault(token, []).append(position)
+
+class DocumentWordIndex:
+    """Lazily built word indexes for the pages of a document, each page is extracted at most once."""
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.pages = {}
+
+    def get(self, page_number):
+        if page_number not in self.pages:
+            self.pages[page_number] = PageWordIndex(self.doc[page_number])
+        return self.pages[page_number]
+
+def normalize_word(word):
+    return re.sub(r"\W+", "", word).lower()
+
+def tokenize(text):
+    return [token for token in (normalize_word(word) for word in text.split()) if token]
+
+def find_exact(index, next_index, tokens):
+    # Look up the candidate start positions of the first token and verify the rest of the snippet,
+    # continuing onto the next page when the snippet runs past the end of its page
+    page_tokens = index.tokens + (next_index.tokens if next_index is not None else [])
+    for start in index.positions.get(tokens[0], []):
+        if page_tokens[start:start + len(tokens)] == tokens:
+            return [(start, start + len(tokens))]
+    return None
+
+def find_fuzzy(index, next_index, tokens):
+    # Highlight the longest runs of matching words if together they cover enough of the snippet
+    page_tokens = index.tokens + (next_index.tokens if next_index is not None else [])
+    matcher = SequenceMatcher(None, page_tokens, tokens, autojunk=False)
+    blocks = [block for block in matcher.get_matching_blocks() if block.size >= FUZZY_MINIMUM_BLOCK]
+    if sum(block.size for block in blocks) < FUZZY_MATCH_THRESHOLD * len(tokens):
+        return None
+    return [(block.a, block.a + block.size) for block in blocks]
+
+def locate_snippet(word_index, page_count, page_number, snippet):
+    # Return {page_number: [word, ...]} for the snippet, searching only from its own page (or the one
+    # before, in case the extractors disagree on where the page starts) into the next page
+    tokens = tokenize(snippet)
+    if not tokens:
+        return {}
+    for candidate in (page_number, page_number - 1):
+        if candidate < 0 or candidate >= page_count:
+            continue
+        index = word_index.get(candidate)
+        next_index = word_index.get(candidate + 1) if candidate + 1 < page_count else None
+        spans = find_exact(index, next_index, tokens) or find_fuzzy(index, next_index, tokens)
+        if spans:
+            return split_spans(index, next_index, candidate, spans)
+    return {}
+
+def split_spans(index, next_index, page_number, spans):
+    # Map word positions in the combined page sequence back to the words of each page
+    words = {}
+    for start, end in spans:
+        for position in range(start, end):
+            if position < len(index.words):
+                words.setdefault(page_number, []).append(index.words[position])
+            else:
+                words.setdefault(page_number + 1, []).append(next_index.words[position - len(index.words)])
+    return words
+
+def line_rects(words):
+    # Merge the rectangles of consecutive words on the same line into one rectangle per line
+    rects = []
+    current_line = None
+    for x0, y0, x1, y1, _, block_no, line_no, _ in words:
+        if (block_no, line_no) == current_line:
+            rect = rects[-1]
+            rects[-1] = (min(rect[0], x0), min(rect[1], y0), max(rect[2], x1), max(rect[3], y1))
+        else:
+            rects.append((x0, y0, x1, y1))
+            current_line = (block_no, line_no)
+    return rects
+
+def annotate_document(doc, snippets):
+    # snippets is a list of (page_number, snippet) with 0-based page numbers
+    # All snippets are resolved first, then the highlights are applied page by page in one pass
+    word_index = DocumentWordIndex(doc)
+    highlights = {}
+    unmatched = 0
+    for page_number, snippet in snippets:
+        located = locate_snippet(word_index, doc.page_count, page_number, snippet)
+        if not located:
+            unmatched += 1
+        for located_page, words in located.items():
+            highlights.setdefault(located_page, []).append(line_rects(words))
+
+    # PyMuPDF is only imported once there is a document to annotate
+    import fitz
+    for page_number in sorted(highlights):
+        page = doc[page_number]
+        for rects in highlights[page_number]:
+            highlight = page.add_highlight_annot([fitz.Rect(rect) for rect in rects])
+            highlight.update()
+    return unmatched
@@ -0,0 +1,55 @@
+import json
+import os
+
+def iter_groups(items, size):
+    # Group an iterable into lists of at most size items
+    group = []
+    for item in items:
+        group.append(item)
+        if len(group) == size:
+            yield group
+            group = []
+    if group:
+        yield group
+
+def iter_jsonl(path, offset=0):
+    # Stream the records of a JSON Lines file, skipping the first offset records.
+    # Blank lines are not records, so they do not count towards the offset either
+    with open(path, "r") as f:
+        records = 0
+        for line in f:
+            if not line.strip():
+                continue
+            records += 1
+            if records > offset:
+                yield json.loads(line)
+
+def get_resume_offset(path):
+    # Count the complete records already written, dropping a partial last line left by a crash
+    if not os.path.exists(path):
+        return 0
+    with open(path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            f.truncate(end)
+    return data[:end].count(b"\n")
+
+def run_batch(input_path, output_path, process_group, group_size=64, offset=None):
+    # Process the input records group by group, appending the results to the output file in input order.
+    # Unless an offset is given, the run resumes after the records already in the output file.
+    # A partial last line left by a crash is dropped either way, so the next record does not join onto it
+    written = get_resume_offset(output_path)
+    if offset is None:
+        offset = written
+    if offset:
+        print(f"Resuming after {offset} records.")
+
+    processed = offset
+    with open(output_path, "a") as out:
+        for group in iter_groups(iter_jsonl(input_path, offset), group_size):
+            for result in process_group(group):
+                out.write(json.dumps(result) + "\n")
+            out.flush()
+            processed += len(group)
+            print(f" - {processed} records processed.")
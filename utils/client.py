@@ -0,0 +1,103 @@
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from utils.metrics import metrics
+
+# Define the retry policy
+max_retries = 5
+backoff_base = 1
+backoff_max = 60
+retryable_status_codes = (429, 500, 502, 503, 504)
+pool_size = 32
+
+class RateLimiter:
+    """Client-side request and token budget, refilled continuously over a one minute window.
+
+    A budget of 0 disables that limit. acquire blocks until the request fits in both budgets.
+    """
+
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.request_allowance = float(requests_per_minute)
+        self.token_allowance = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        if self.requests_per_minute:
+            self.request_allowance = min(self.requests_per_minute, self.request_allowance + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self.token_allowance = min(self.tokens_per_minute, self.token_allowance + elapsed * self.tokens_per_minute / 60)
+
+    def acquire(self, tokens=0):
+        # A single request larger than the whole budget is capped so that it can still go through
+        if self.tokens_per_minute:
+            tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self.lock:
+                self.refill(time.monotonic())
+                wait = 0
+                if self.requests_per_minute and self.request_allowance < 1:
+                    wait = max(wait, (1 - self.request_allowance) * 60 / self.requests_per_minute)
+                if self.tokens_per_minute and self.token_allowance < tokens:
+                    wait = max(wait, (tokens - self.token_allowance) * 60 / self.tokens_per_minute)
+                if wait == 0:
+                    if self.requests_per_minute:
+                        self.request_allowance -= 1
+                    if self.tokens_per_minute:
+                        self.token_allowance -= tokens
+                    return
+            time.sleep(wait)
+
+def create_session(headers):
+    # Pooled keep-alive session, sized for the thread pools that share it
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(headers)
+    return session
+
+def get_retry_delay(response, attempt):
+    # Honour Retry-After (seconds) when the service sends it, otherwise back off exponentially with jitter
+    if response is not None:
+        retry_after = response.headers.get("retry-after-ms")
+        if retry_after is not None:
+            try:
+                return float(retry_after) / 1000
+            except ValueError:
+                pass
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+    return min(backoff_max, backoff_base * 2 ** attempt) * (0.5 + random.random() / 2)
+
+def send_request(session, method, url, rate_limiter=None, tokens=0, service="http", **kwargs):
+    # Send the request, retrying throttled, failed and timed out requests. The last response is returned
+    # (or the last connection error raised) once the retries are exhausted, callers still call raise_for_status.
+    # The request is recorded once in the run metrics under service, with the number of retries it took
+    start = time.perf_counter()
+    for attempt in range(max_retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.acquire(tokens)
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if attempt == max_retries:
+                metrics.record_request(service, None, time.perf_counter() - start, attempt)
+                raise
+            time.sleep(get_retry_delay(None, attempt))
+            continue
+        if response.status_code not in retryable_status_codes or attempt == max_retries:
+            body = response.request.body or b""
+            metrics.record_request(service, response.status_code, time.perf_counter() - start, attempt, len(body), len(response.content))
+            return response
+        time.sleep(get_retry_delay(response, attempt))
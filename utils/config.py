@@ -0,0 +1,35 @@
+import configparser
+import os
+import threading
+
+# Repository root, relative paths in the config file are resolved against it
+root_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# The parsed config file, shared by all modules
+config = None
+config_lock = threading.Lock()
+
+def get_config_path():
+    # VECTORDB_CONFIG points to an alternative config file
+    return os.environ.get('VECTORDB_CONFIG', os.path.join(root_path, 'settings', 'config.ini'))
+
+def get_config():
+    # Read the config.ini file once, a missing file or section only fails when a required value is used
+    global config
+    with config_lock:
+        if config is None:
+            parser = configparser.ConfigParser()
+            parser.read(get_config_path())
+            config = parser
+        return config
+
+def require(section, option):
+    # Return a value that must be set, with an error naming the missing setting otherwise
+    value = get_config().get(section, option, fallback='')
+    if not value:
+        raise Exception(f"Missing '{option}' in the [{section}] section of {get_config_path()}")
+    return value
+
+def get_path(section, option, fallback):
+    # Resolve a path setting against the repository root
+    return os.path.join(root_path, get_config().get(section, option, fallback=fallback))
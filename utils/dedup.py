@@ -0,0 +1,51 @@
+import hashlib
+import re
+
+# Fingerprint size, number of LSH bands and the largest Hamming distance treated as a near-duplicate
+SIMHASH_BITS = 64
+SIMHASH_BANDS = 4
+SIMHASH_MAX_DISTANCE = 3
+SHINGLE_SIZE = 3
+
+def simhash(text):
+    # 64-bit SimHash over word shingles, near-identical texts differ in only a few bits
+    words = re.findall(r"\w+", text.lower())
+    shingles = [" ".join(words[i:i + SHINGLE_SIZE]) for i in range(max(1, len(words) - SHINGLE_SIZE + 1))]
+    counts = [0] * SIMHASH_BITS
+    for shingle in shingles:
+        value = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(SIMHASH_BITS):
+            counts[bit] += 1 if value >> bit & 1 else -1
+    fingerprint = 0
+    for bit, count in enumerate(counts):
+        if count > 0:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+class NearDuplicateIndex:
+    """Clusters texts by SimHash, each cluster is represented by the first text added to it.
+
+    Fingerprints are split into bands, any two fingerprints within SIMHASH_MAX_DISTANCE bits
+    share at least one identical band, so only texts sharing a band are compared.
+    """
+
+    def __init__(self):
+        self.band_bits = SIMHASH_BITS // SIMHASH_BANDS
+        self.bands = [{} for _ in range(SIMHASH_BANDS)]
+
+    def band_keys(self, fingerprint):
+        mask = (1 << self.band_bits) - 1
+        return [fingerprint >> (band * self.band_bits) & mask for band in range(SIMHASH_BANDS)]
+
+    def find_or_add(self, text, key):
+        # Return the key of the representative this text is a near-duplicate of, or add it as a new
+        # representative under key and return None
+        fingerprint = simhash(text)
+        band_keys = self.band_keys(fingerprint)
+        for band, band_key in zip(self.bands, band_keys):
+            for candidate_fingerprint, candidate_key in band.get(band_key, []):
+                if bin(fingerprint ^ candidate_fingerprint).count("1") <= SIMHASH_MAX_DISTANCE:
+                    return candidate_key
+        for band, band_key in zip(self.bands, band_keys):
+            band.setdefault(band_key, []).append((fingerprint, key))
+        return None
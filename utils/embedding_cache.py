@@ -0,0 +1,96 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+
+class EmbeddingCache:
+    """Disk-backed embedding cache keyed by a hash of the deployment name and the input text.
+
+    Vectors are stored as packed float32 blobs in SQLite. When the number of entries
+    exceeds max_entries the least recently used entries are evicted.
+    """
+
+    def __init__(self, path, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # The cache is shared by the app and the worker processes, so writers wait for each other instead of failing
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)")
+        self.connection.commit()
+
+    @staticmethod
+    def make_key(deployment_name, text):
+        # Content-addressed key, the same text embedded by the same deployment always maps to the same entry
+        return hashlib.sha256(f"{deployment_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, deployment_name, texts):
+        # Return a list aligned with texts, with None for every miss
+        keys = [self.make_key(deployment_name, text) for text in texts]
+        found = {}
+        with self.lock:
+            # Stay well below SQLite's host parameter limit
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self.connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self.connection.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE key = ?", [(now, key) for key in found]
+                )
+                self.connection.commit()
+        return [self.unpack(found[key]) if key in found else None for key in keys]
+
+    def get(self, deployment_name, text):
+        return self.get_many(deployment_name, [text])[0]
+
+    def put_many(self, deployment_name, texts, embeddings):
+        # Store the embeddings, skipping failed (None) entries, then evict down to the size cap
+        now = time.time()
+        rows = [
+            (self.make_key(deployment_name, text), self.pack(embedding), now)
+            for text, embedding in zip(texts, embeddings)
+            if embedding is not None
+        ]
+        if not rows:
+            return
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_access) VALUES (?, ?, ?)", rows
+            )
+            self.evict()
+            self.connection.commit()
+
+    def put(self, deployment_name, text, embedding):
+        self.put_many(deployment_name, [text], [embedding])
+
+    def evict(self):
+        count = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if count > self.max_entries:
+            self.connection.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY last_access ASC LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    @staticmethod
+    def pack(embedding):
+        return array("f", embedding).tobytes()
+
+    @staticmethod
+    def unpack(blob):
+        vector = array("f")
+        vector.frombytes(blob)
+        return vector.tolist()
@@ -0,0 +1,143 @@
+import json
+import os
+import numpy as np
+
+# Storage types, int8 uses symmetric scalar quantization with one float32 scale per vector
+DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+class StoredVector:
+    """A vector of the store, dequantized to float32 only when it is serialized or converted to an array."""
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+
+    def __array__(self, dtype=None, copy=None):
+        vector = self.store.vector(self.row)
+        return vector if dtype is None else vector.astype(dtype)
+
+    def tolist(self):
+        return self.store.vector(self.row).tolist()
+
+class EmbeddingStore:
+    """Compact on-disk embedding store keyed by document id.
+
+    The vectors are kept in a memory-mapped .npy file in float32, float16 or int8, next to a
+    JSON list of ids (and a .npy of scales for int8), so loading reads no vector data up front.
+    """
+
+    def __init__(self, path, ids, vectors, scales=None):
+        self.path = path
+        self.ids = ids
+        self.rows = {id: row for row, id in enumerate(ids)}
+        self.vectors = vectors
+        self.scales = scales
+
+    @staticmethod
+    def paths(path):
+        return path + ".ids.json", path + ".vectors.npy", path + ".scales.npy"
+
+    @classmethod
+    def exists(cls, path):
+        ids_path, vectors_path, _ = cls.paths(path)
+        return os.path.exists(ids_path) and os.path.exists(vectors_path)
+
+    @classmethod
+    def load(cls, path):
+        ids_path, vectors_path, scales_path = cls.paths(path)
+        with open(ids_path, "r") as f:
+            ids = json.load(f)
+        vectors = np.load(vectors_path, mmap_mode="r")
+        scales = np.load(scales_path, mmap_mode="r") if vectors.dtype == np.int8 else None
+        return cls(path, ids, vectors, scales)
+
+    @classmethod
+    def write(cls, path, ids, get_vector, dimensions, dtype="float32"):
+        # Write the vectors of ids one row at a time, get_vector(id) returns a float32 vector
+        writer = EmbeddingStoreWriter(path, len(ids), dtype, dimensions)
+        for id in ids:
+            writer.add(id, get_vector(id))
+        return writer.close()
+
+    @classmethod
+    def remove(cls, path):
+        for file_path in cls.paths(path):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def __contains__(self, id):
+        return id in self.rows
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def dimensions(self):
+        return self.vectors.shape[1]
+
+    def vector(self, row):
+        # Dequantized float32 copy of one row
+        vector = np.asarray(self.vectors[row], dtype=np.float32)
+        if self.scales is not None:
+            vector = vector * self.scales[row]
+        return vector
+
+    def get(self, id):
+        row = self.rows.get(id)
+        return StoredVector(self, row) if row is not None else None
+
+class EmbeddingStoreWriter:
+    """Writes a new embedding store row by row, quantizing every vector as it is added.
+
+    Only the rows written so far are held, in the store's type in a memory-mapped file, so
+    the full float32 matrix is never held in memory. The store holds room for at most rows
+    vectors, rows beyond the added ids stay unused. close() replaces the files atomically.
+    """
+
+    def __init__(self, path, rows, dtype="float32", dimensions=None):
+        self.path = path
+        self.rows = rows
+        self.dtype = dtype
+        self.dimensions = dimensions
+        self.ids = []
+        self.vectors = None
+        self.scales = None
+
+    def open(self, dimensions):
+        _, vectors_path, scales_path = EmbeddingStore.paths(self.path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.dimensions = dimensions
+        self.vectors = np.lib.format.open_memmap(vectors_path + ".tmp", mode="w+", dtype=DTYPES[self.dtype], shape=(self.rows, dimensions))
+        if self.dtype == "int8":
+            self.scales = np.lib.format.open_memmap(scales_path + ".tmp", mode="w+", dtype=np.float32, shape=(self.rows,))
+
+    def add(self, id, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        if self.vectors is None:
+            # The dimensions are only known once the first vector arrives
+            self.open(vector.shape[0])
+        row = len(self.ids)
+        if self.scales is not None:
+            scale = float(np.abs(vector).max()) / 127 or 1.0
+            self.vectors[row] = np.round(vector / scale).astype(np.int8)
+            self.scales[row] = scale
+        else:
+            self.vectors[row] = vector
+        self.ids.append(id)
+
+    def close(self):
+        # Replace the store's files with the written ones and return the store
+        ids_path, vectors_path, scales_path = EmbeddingStore.paths(self.path)
+        if self.vectors is None:
+            self.open(self.dimensions or 0)
+        self.vectors.flush()
+        self.vectors = None
+        os.replace(vectors_path + ".tmp", vectors_path)
+        if self.scales is not None:
+            self.scales.flush()
+            self.scales = None
+            os.replace(scales_path + ".tmp", scales_path)
+        with open(ids_path + ".tmp", "w") as f:
+            json.dump(self.ids, f)
+        os.replace(ids_path + ".tmp", ids_path)
+        return EmbeddingStore.load(self.path)
@@ -0,0 +1,166 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from utils.config import get_config, get_path
+
+# Get values from the config file
+config = get_config()
+# Relative paths are resolved against the repository root
+jobs_path = get_path('jobs', 'path', 'data/jobs')
+# Worker processes started by worker.py, each classifies one document at a time
+job_workers = config.getint('jobs', 'workers', fallback=2)
+# Seconds without a heartbeat after which a running job is resumed by another worker
+job_stale_seconds = config.getint('jobs', 'stale_seconds', fallback=120)
+# Seconds between queue polls of idle workers and of the Streamlit jobs page
+job_poll_seconds = config.getfloat('jobs', 'poll_seconds', fallback=2)
+
+# Job states, a running job whose worker stopped sending heartbeats is claimed again
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+class JobQueue:
+    """SQLite-backed queue of document classification jobs with per-chunk checkpoints.
+
+    The uploaded PDFs and annotated results are stored as files in directory, next to the
+    jobs.sqlite database shared by the Streamlit page and the worker processes.
+    """
+
+    def __init__(self, directory, stale_seconds=120):
+        self.directory = directory
+        self.stale_seconds = stale_seconds
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(directory, "files"), exist_ok=True)
+        # The queue is shared between processes, so writers wait for each other instead of failing
+        self.connection = sqlite3.connect(os.path.join(directory, "jobs.sqlite"), timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, options TEXT NOT NULL, status TEXT NOT NULL, "
+            "worker TEXT, created REAL NOT NULL, updated REAL NOT NULL, heartbeat REAL, "
+            "chunks_done INTEGER NOT NULL DEFAULT 0, pages_read INTEGER NOT NULL DEFAULT 0, pages INTEGER, "
+            "unmatched INTEGER, error TEXT)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "job_id INTEGER NOT NULL, chunk_number INTEGER NOT NULL, row TEXT NOT NULL, PRIMARY KEY (job_id, chunk_number))"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+
+    def file_path(self, job_id, suffix):
+        return os.path.join(self.directory, "files", f"{job_id}.{suffix}")
+
+    def submit(self, name, file_data, options=None):
+        # Store the PDF and queue a job for it, returning the job id
+        now = time.time()
+        with self.lock:
+            cursor = self.connection.execute(
+                "INSERT INTO jobs (name, options, status, created, updated) VALUES (?, ?, ?, ?, ?)",
+                (name, json.dumps(options or {}), QUEUED, now, now),
+            )
+            job_id = cursor.lastrowid
+        # The job is only claimable once its file exists
+        with open(self.file_path(job_id, "pdf.tmp"), "wb") as f:
+            f.write(file_data)
+        os.replace(self.file_path(job_id, "pdf.tmp"), self.file_path(job_id, "pdf"))
+        return job_id
+
+    def claim(self, worker):
+        # Atomically take the oldest queued job, or a running job whose worker went quiet, and return it or None
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.connection.execute(
+                    "SELECT id FROM jobs WHERE status = ? OR (status = ? AND heartbeat < ?) ORDER BY id",
+                    (QUEUED, RUNNING, now - self.stale_seconds),
+                ).fetchall()
+                job_id = next((job_id for job_id, in rows if os.path.exists(self.file_path(job_id, "pdf"))), None)
+                if job_id is not None:
+                    self.connection.execute(
+                        "UPDATE jobs SET status = ?, worker = ?, heartbeat = ?, updated = ?, error = NULL WHERE id = ?",
+                        (RUNNING, worker, now, now, job_id),
+                    )
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        return self.get(job_id) if job_id is not None else None
+
+    def checkpoint(self, job_id, rows, pages_read=None, pages=None):
+        # Persist finished rows of a job and refresh its heartbeat in one transaction
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO chunks (job_id, chunk_number, row) VALUES (?, ?, ?)",
+                    [(job_id, row["chunk_number"], json.dumps(row)) for row in rows],
+                )
+                self.connection.execute(
+                    "UPDATE jobs SET heartbeat = ?, updated = ?, pages_read = COALESCE(?, pages_read), pages = COALESCE(?, pages), "
+                    "chunks_done = (SELECT COUNT(*) FROM chunks WHERE job_id = ?) WHERE id = ?",
+                    (now, now, pages_read, pages, job_id, job_id),
+                )
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def finish(self, job_id, annotated_pdf, unmatched=0):
+        with open(self.file_path(job_id, "annotated.pdf.tmp"), "wb") as f:
+            f.write(annotated_pdf)
+        os.replace(self.file_path(job_id, "annotated.pdf.tmp"), self.file_path(job_id, "annotated.pdf"))
+        self.set_status(job_id, DONE, unmatched=unmatched)
+
+    def fail(self, job_id, error):
+        self.set_status(job_id, FAILED, error=str(error))
+
+    def retry(self, job_id):
+        # Queue a failed job again, its checkpointed chunks are kept
+        self.set_status(job_id, QUEUED)
+
+    def set_status(self, job_id, status, unmatched=None, error=None):
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "UPDATE jobs SET status = ?, updated = ?, unmatched = COALESCE(?, unmatched), error = ? WHERE id = ?",
+                (status, now, unmatched, error, job_id),
+            )
+
+    def get(self, job_id):
+        jobs = self.list(job_id)
+        return jobs[0] if jobs else None
+
+    def list(self, job_id=None):
+        # Jobs newest first as dictionaries
+        with self.lock:
+            cursor = self.connection.execute(
+                "SELECT * FROM jobs" + (" WHERE id = ?" if job_id is not None else "") + " ORDER BY id DESC",
+                (job_id,) if job_id is not None else (),
+            )
+            columns = [column[0] for column in cursor.description]
+            jobs = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        for job in jobs:
+            job["options"] = json.loads(job["options"])
+        return jobs
+
+    def rows(self, job_id):
+        # Checkpointed rows of a job as {chunk_number: row}
+        with self.lock:
+            rows = self.connection.execute("SELECT chunk_number, row FROM chunks WHERE job_id = ?", (job_id,)).fetchall()
+        return {chunk_number: json.loads(row) for chunk_number, row in rows}
+
+# The queue is opened on first use and shared by all threads of a process
+job_queue = None
+job_queue_lock = threading.Lock()
+
+def get_job_queue():
+    global job_queue
+    with job_queue_lock:
+        if job_queue is None:
+            job_queue = JobQueue(jobs_path, job_stale_seconds)
+        return job_queue
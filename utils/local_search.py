@@ -0,0 +1,155 @@
+import json
+import os
+import numpy as np
+
+# Rows scored per matrix multiply, a float16 or int8 matrix is only converted to float32 one block at a time
+SEARCH_BLOCK_ROWS = 16384
+
+class LocalVectorIndex:
+    """In-process vector index over the labelled documents.
+
+    The vectors are usually the memory-mapped matrix of the embedding store, in float32,
+    float16 or int8, and are scored block by block, so a cosine top-k query is a few
+    matrix multiplies followed by argpartition. The cosine ignores the per-vector scale of
+    int8 rows, so they are used without dequantizing them. The document fields are plain
+    lists, only the vectors are NumPy arrays.
+    """
+
+    def __init__(self, ids, contents, categories, vectors, labels=None, store=None):
+        self.ids = list(ids)
+        self.contents = list(contents)
+        self.categories = list(categories)
+        # Optional is_special_commitment label per document, None when the document is unlabelled
+        self.labels = list(labels) if labels is not None else [None] * len(self.ids)
+        self.vectors = vectors
+        self.inverse_norms = get_inverse_norms(vectors)
+        # The embedding store the vectors belong to, or None when the index holds its own float32 vectors
+        self.store = store
+
+    @classmethod
+    def from_store(cls, ids, contents, categories, labels, store):
+        # Use the store's matrix as it is when the index covers all of its rows in order,
+        # otherwise copy the rows of ids in the store's type
+        missing = [id for id in ids if id not in store]
+        if missing:
+            raise Exception(f"Embedding store {store.path} has no vectors for {len(missing)} documents of the local index, run populate_vector_index.py to rebuild it")
+        rows = [store.rows[id] for id in ids]
+        vectors = store.vectors if rows == list(range(len(store.vectors))) else np.take(store.vectors, rows, axis=0)
+        return cls(ids, contents, categories, vectors, labels, store)
+
+    @classmethod
+    def from_documents(cls, documents, store=None):
+        # Build the index from documents in the search upload format (id, content, category, contentVector),
+        # with the vectors of the embedding store the documents were built from when it is given
+        ids = [document["id"] for document in documents]
+        contents = [document["content"] for document in documents]
+        categories = [document["category"] for document in documents]
+        labels = [document.get("isSpecialCommitment") for document in documents]
+        if store is not None:
+            return cls.from_store(ids, contents, categories, labels, store)
+        return cls(ids, contents, categories, np.array([document["contentVector"] for document in documents], dtype=np.float32).reshape(len(documents), -1), labels)
+
+    @staticmethod
+    def read_fields(path):
+        # Return the document fields of a saved index ({"ids": [...], "contents": [...], "categories": [...], "labels": [...]})
+        # with its vectors, which are None when they are in the embedding store
+        with np.load(path) as data:
+            if "fields" not in data.files:
+                # Indexes saved before the fields were stored as JSON hold them in fixed-width string arrays
+                fields = {
+                    "ids": [str(id) for id in data["ids"]],
+                    "contents": [str(content) for content in data["contents"]],
+                    "categories": [str(category) for category in data["categories"]],
+                    "labels": [str(label) or None for label in data["labels"]] if "labels" in data.files else [None] * len(data["ids"]),
+                }
+            else:
+                fields = json.loads(data["fields"].tobytes().decode("utf-8"))
+            return fields, data["vectors"] if "vectors" in data.files else None
+
+    @classmethod
+    def load(cls, path, store=None):
+        # The index is a single uncompressed .npz file, holding the vectors too unless they are in the embedding store
+        fields, vectors = cls.read_fields(path)
+        if vectors is not None:
+            return cls(fields["ids"], fields["contents"], fields["categories"], vectors, fields["labels"])
+        if store is None:
+            raise Exception(f"Local index {path} keeps its vectors in the embedding store, which does not exist, run populate_vector_index.py to rebuild it")
+        return cls.from_store(fields["ids"], fields["contents"], fields["categories"], fields["labels"], store)
+
+    def save(self, path):
+        # A fixed-width string array would pad every document to the longest one, so the
+        # document fields are stored as UTF-8 JSON bytes, next to the vectors unless they are in the embedding store
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        fields = json.dumps({"ids": self.ids, "contents": self.contents, "categories": self.categories, "labels": self.labels}).encode("utf-8")
+        arrays = {"fields": np.frombuffer(fields, dtype=np.uint8)}
+        if self.store is None:
+            arrays["vectors"] = self.vectors
+        with open(path, "wb") as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def updated(cls, path, documents, removed_ids, store):
+        # Return the index saved at path without removed_ids and with documents appended, with the vectors
+        # of the embedding store rewritten for this update. Only the document fields of the saved index are read
+        fields, _ = cls.read_fields(path)
+        removed_ids = set(removed_ids)
+        keep = [row for row, id in enumerate(fields["ids"]) if id not in removed_ids]
+        return cls.from_store(
+            [fields["ids"][row] for row in keep] + [document["id"] for document in documents],
+            [fields["contents"][row] for row in keep] + [document["content"] for document in documents],
+            [fields["categories"][row] for row in keep] + [document["category"] for document in documents],
+            [fields["labels"][row] for row in keep] + [document.get("isSpecialCommitment") for document in documents],
+            store,
+        )
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, embeddings, number_of_nearest_neighbors=1):
+        # Return the top-k (indices, scores) for each query, best match first
+        queries = normalize(np.atleast_2d(np.asarray(embeddings, dtype=np.float32)))
+        k = min(number_of_nearest_neighbors, len(self))
+        if k == 0:
+            empty = np.empty((len(queries), 0))
+            return empty.astype(np.int64), empty.astype(np.float32)
+        scores = np.empty((len(queries), len(self)), dtype=np.float32)
+        for start in range(0, len(self), SEARCH_BLOCK_ROWS):
+            block = np.asarray(self.vectors[start:start + SEARCH_BLOCK_ROWS], dtype=np.float32)
+            scores[:, start:start + len(block)] = queries @ block.T
+        scores *= self.inverse_norms
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+    def query(self, embedding, number_of_nearest_neighbors=1):
+        return self.query_batch([embedding], number_of_nearest_neighbors)[0]
+
+    def query_batch(self, embeddings, number_of_nearest_neighbors=1):
+        # Return one search response per query, in the same shape as the Azure Cognitive Search response
+        indices, scores = self.search(embeddings, number_of_nearest_neighbors)
+        return [
+            {"value": [
+                {
+                    "@search.score": float(score),
+                    "content": self.contents[index],
+                    "category": self.categories[index],
+                    "isSpecialCommitment": self.labels[index],
+                }
+                for index, score in zip(row_indices, row_scores)
+            ]}
+            for row_indices, row_scores in zip(indices, scores)
+        ]
+
+def get_inverse_norms(vectors):
+    # 1 / L2 norm of every row, computed block by block, zero rows keep a score of 0
+    norms = np.empty(len(vectors), dtype=np.float32)
+    for start in range(0, len(vectors), SEARCH_BLOCK_ROWS):
+        norms[start:start + SEARCH_BLOCK_ROWS] = np.linalg.norm(np.asarray(vectors[start:start + SEARCH_BLOCK_ROWS], dtype=np.float32), axis=1)
+    norms[norms == 0] = 1
+    return 1 / norms
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
@@ -0,0 +1,45 @@
+import hashlib
+import json
+import os
+
+def document_id(document):
+    # Stable search key derived from the category, content and optional label, identical documents always get the same id
+    key = f"{document['category']}\0{document['content']}"
+    if document.get("is_special_commitment") is not None:
+        key += f"\0{get_label(document)}"
+    content_hash = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    return content_hash[:32]
+
+def get_label(document):
+    # Optional is_special_commitment label of a labelled example, as "TRUE" or "FALSE"
+    label = document.get("is_special_commitment")
+    if label is None:
+        return None
+    return str(label).upper()
+
+def load_manifest(path):
+    # The manifest maps the id of every document in the index to its category
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+def save_manifest(path, documents):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    manifest = {document_id(document): document["category"] for document in documents}
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=4)
+
+def diff_manifest(manifest, documents):
+    # Return the documents that are not in the index yet and the ids that are no longer in the file
+    # An edited document gets a new id, so it shows up as one addition plus one removal
+    ids = {document_id(document) for document in documents}
+    added = []
+    seen = set()
+    for document in documents:
+        id = document_id(document)
+        if id not in manifest and id not in seen:
+            added.append(document)
+        seen.add(id)
+    removed = [id for id in manifest if id not in ids]
+    return added, removed
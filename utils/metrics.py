@@ -0,0 +1,145 @@
+import contextvars
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+class Metrics:
+    """Thread-safe collector of stage timings and outbound request statistics for one run."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.durations = {}
+            self.requests = {}
+            self.usage = {}
+
+    @contextmanager
+    def timed(self, stage):
+        # Time the enclosed block as one occurrence of the stage
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def record(self, stage, duration):
+        with self.lock:
+            self.durations.setdefault(stage, []).append(duration)
+
+    def record_request(self, service, status_code, duration, retries=0, request_bytes=0, response_bytes=0):
+        # status_code is None when the request failed without a response
+        self.record(f"request:{service}", duration)
+        with self.lock:
+            stats = self.requests.setdefault(service, {"count": 0, "retries": 0, "request_bytes": 0, "response_bytes": 0, "status_codes": {}})
+            stats["count"] += 1
+            stats["retries"] += retries
+            stats["request_bytes"] += request_bytes
+            stats["response_bytes"] += response_bytes
+            status = str(status_code) if status_code is not None else "error"
+            stats["status_codes"][status] = stats["status_codes"].get(status, 0) + 1
+
+    def record_usage(self, service, usage):
+        # Accumulate the token usage reported in a response body ({"prompt_tokens": ..., "total_tokens": ...})
+        if not usage:
+            return
+        with self.lock:
+            totals = self.usage.setdefault(service, {})
+            for key, value in usage.items():
+                if isinstance(value, (int, float)):
+                    totals[key] = totals.get(key, 0) + value
+
+    def summary(self):
+        # Per-stage count, total and percentiles in seconds, with the request and token usage totals
+        with self.lock:
+            stages = {}
+            for stage, durations in self.durations.items():
+                ordered = sorted(durations)
+                stages[stage] = {
+                    "count": len(ordered),
+                    "total": sum(ordered),
+                    "p50": percentile(ordered, 50),
+                    "p90": percentile(ordered, 90),
+                    "p99": percentile(ordered, 99),
+                    "max": ordered[-1],
+                }
+            return {
+                "elapsed": time.time() - self.started,
+                "stages": stages,
+                "requests": json.loads(json.dumps(self.requests)),
+                "usage": json.loads(json.dumps(self.usage)),
+            }
+
+    def to_json(self):
+        return summary_to_json(self.summary())
+
+def summary_to_json(summary):
+    return json.dumps(summary, indent=4)
+
+def summary_to_prometheus(summary):
+    # Prometheus text exposition format of a summary() snapshot
+    lines = [
+        "# TYPE vectordb_stage_duration_seconds summary",
+    ]
+    for stage, stats in sorted(summary["stages"].items()):
+        for quantile in ("p50", "p90", "p99"):
+            lines.append(f'vectordb_stage_duration_seconds{{stage="{stage}",quantile="0.{quantile[1:]}"}} {stats[quantile]:.6f}')
+        lines.append(f'vectordb_stage_duration_seconds_sum{{stage="{stage}"}} {stats["total"]:.6f}')
+        lines.append(f'vectordb_stage_duration_seconds_count{{stage="{stage}"}} {stats["count"]}')
+    lines.append("# TYPE vectordb_requests_total counter")
+    for service, stats in sorted(summary["requests"].items()):
+        for status, count in sorted(stats["status_codes"].items()):
+            lines.append(f'vectordb_requests_total{{service="{service}",status="{status}"}} {count}')
+    lines.append("# TYPE vectordb_request_retries_total counter")
+    for service, stats in sorted(summary["requests"].items()):
+        lines.append(f'vectordb_request_retries_total{{service="{service}"}} {stats["retries"]}')
+    lines.append("# TYPE vectordb_request_bytes_total counter")
+    for service, stats in sorted(summary["requests"].items()):
+        lines.append(f'vectordb_request_bytes_total{{service="{service}",direction="sent"}} {stats["request_bytes"]}')
+        lines.append(f'vectordb_request_bytes_total{{service="{service}",direction="received"}} {stats["response_bytes"]}')
+    lines.append("# TYPE vectordb_tokens_total counter")
+    for service, usage in sorted(summary["usage"].items()):
+        for key, value in sorted(usage.items()):
+            lines.append(f'vectordb_tokens_total{{service="{service}",type="{key}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+def percentile(ordered, p):
+    # Nearest-rank percentile of an already sorted list
+    if not ordered:
+        return 0
+    rank = max(1, -(-p * len(ordered) // 100))
+    return ordered[int(rank) - 1]
+
+# Metrics of the process, used when no run has its own (worker jobs, command line tools, benchmarks)
+default_metrics = Metrics()
+current_metrics = contextvars.ContextVar("current_metrics", default=default_metrics)
+
+class CurrentMetrics:
+    """The Metrics of the run in the current context, what the modules record into through `metrics`."""
+
+    def __getattr__(self, name):
+        return getattr(current_metrics.get(), name)
+
+@contextmanager
+def use_metrics(run_metrics):
+    # Record into run_metrics in the enclosed block, so that runs of concurrent sessions are kept apart
+    token = current_metrics.set(run_metrics)
+    try:
+        yield run_metrics
+    finally:
+        current_metrics.reset(token)
+
+def bind_metrics(function):
+    # Return function running with the Metrics of the caller, for the threads of an executor,
+    # which do not inherit the caller's context
+    run_metrics = current_metrics.get()
+    def bound(*args, **kwargs):
+        with use_metrics(run_metrics):
+            return function(*args, **kwargs)
+    return bound
+
+metrics = CurrentMetrics()
@@ -1,28 +1,78 @@
 import requests
-import configparser
-import os
-
-# Get the path to the config.ini file
-config_path = os.path.join(os.path.dirname(__file__), '..', 'settings', 'config.ini')
-
-# Read the config.ini file
-config = configparser.ConfigParser()
-config.read(config_path)
+import threading
+from utils.config import get_config, get_path, require
+from utils.client import RateLimiter, create_session, send_request
+from utils.metrics import metrics
+from utils.tokens import count_tokens
 
 # Get values from the config file
-openai_api_key = config.get('openai', 'openai_api_key')
-openai_service_name = config.get('openai', 'openai_service_name')
-embedding_deployment_name = config.get('openai', 'embedding_deployment_name')
-chat_deployment_name = config.get('openai', 'chat_deployment_name')
+config = get_config()
+embedding_deployment_name = config.get('openai', 'embedding_deployment_name', fallback='text-embedding-ada-002')
+chat_deployment_name = config.get('openai', 'chat_deployment_name', fallback='gpt-35-turbo')
+embedding_cache_enabled = config.getboolean('cache', 'embedding_cache_enabled', fallback=True)
+# Relative cache paths are resolved against the repository root
+embedding_cache_path = get_path('cache', 'embedding_cache_path', 'cache/embeddings.sqlite')
+embedding_cache_max_entries = config.getint('cache', 'embedding_cache_max_entries', fallback=100000)
+# Client-side quota per deployment, 0 disables the limit
+embedding_requests_per_minute = config.getint('openai', 'embedding_requests_per_minute', fallback=0)
+embedding_tokens_per_minute = config.getint('openai', 'embedding_tokens_per_minute', fallback=0)
+chat_requests_per_minute = config.getint('openai', 'chat_requests_per_minute', fallback=0)
+chat_tokens_per_minute = config.getint('openai', 'chat_tokens_per_minute', fallback=0)
 
 # Define the variable values
 openai_api_version = "2023-05-15"
-openai_headers = {"Content-Type": "application/json", "api-key": openai_api_key}
-base_url = f"https://{openai_service_name}.openai.azure.com"
+
+# Rate limiters shared by all requests to the service
+embedding_rate_limiter = RateLimiter(embedding_requests_per_minute, embedding_tokens_per_minute)
+chat_rate_limiter = RateLimiter(chat_requests_per_minute, chat_tokens_per_minute)
+
+# Limits for a single embeddings request
+embedding_batch_size = 16
+embedding_batch_token_limit = 8191
+
+# The keep-alive session and the embedding cache are created on first use, so that importing
+# this module neither needs the credentials nor opens the cache database
+openai_session = None
+embedding_cache = None
+embedding_cache_loaded = False
+client_lock = threading.Lock()
+
+def get_base_url():
+    endpoint = config.get('openai', 'openai_endpoint', fallback='')
+    if endpoint:
+        return endpoint.rstrip("/")
+    return f"https://{require('openai', 'openai_service_name')}.openai.azure.com"
+
+def get_openai_session():
+    # Shared keep-alive session for all requests to the service
+    global openai_session
+    with client_lock:
+        if openai_session is None:
+            openai_session = create_session({"Content-Type": "application/json", "api-key": require('openai', 'openai_api_key')})
+        return openai_session
+
+def get_embedding_cache():
+    # Persistent embedding cache in front of the embeddings endpoint, None when disabled
+    global embedding_cache, embedding_cache_loaded
+    with client_lock:
+        if not embedding_cache_loaded:
+            if embedding_cache_enabled:
+                from utils.embedding_cache import EmbeddingCache
+                embedding_cache = EmbeddingCache(embedding_cache_path, embedding_cache_max_entries)
+            embedding_cache_loaded = True
+        return embedding_cache
 
 def generate_query_embedding(input):
+    embedding_cache = get_embedding_cache()
+
+    # Return the cached embedding if this text has been embedded before
+    if embedding_cache is not None:
+        cached_embedding = embedding_cache.get(embedding_deployment_name, input)
+        if cached_embedding is not None:
+            return cached_embedding
+
     # Define the REST API endpoint
-    url = f"{base_url}/openai/deployments/{embedding_deployment_name}/embeddings?api-version={openai_api_version}"
+    url = f"{get_base_url()}/openai/deployments/{embedding_deployment_name}/embeddings?api-version={openai_api_version}"
 
     # Define the request body
     request_body = {
@@ -31,20 +81,80 @@ def generate_query_embedding(input):
 
     # Generate the query embedding
     try:
-        response = requests.post(url, headers=openai_headers, json=request_body, timeout=10)
+        response = send_request(get_openai_session(), "POST", url, embedding_rate_limiter, estimate_token_count(input), "embeddings", json=request_body, timeout=10)
         response.raise_for_status()
         # Parse the response body as JSON
         query_embedding_response = response.json()
+        metrics.record_usage("embeddings", query_embedding_response.get("usage"))
         # Get the embedding from the response
         query_embedding = query_embedding_response["data"][0]["embedding"]
+        if embedding_cache is not None:
+            embedding_cache.put(embedding_deployment_name, input, query_embedding)
         return query_embedding
     except requests.exceptions.RequestException as e:
         print(f"Error generating query embedding: {e}")
         return None
 
+def estimate_token_count(text):
+    # Token count with tiktoken when it is installed, otherwise estimated from the length
+    return count_tokens(text)
+
+def batch_inputs(inputs, batch_size=embedding_batch_size, token_limit=embedding_batch_token_limit, token_counts=None):
+    # Split the inputs into batches bounded by item count and token count, yielding their positions.
+    # token_counts holds the known token count of each input, e.g. from the chunker
+    batch = []
+    batch_tokens = 0
+    for i, text in enumerate(inputs):
+        tokens = token_counts[i] if token_counts is not None else estimate_token_count(text)
+        if batch and (len(batch) >= batch_size or batch_tokens + tokens > token_limit):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(i)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+def generate_query_embeddings(inputs, token_counts=None):
+    # Define the REST API endpoint
+    url = f"{get_base_url()}/openai/deployments/{embedding_deployment_name}/embeddings?api-version={openai_api_version}"
+    embedding_cache = get_embedding_cache()
+
+    # Look up the cached embeddings, only the misses are sent to the service
+    if embedding_cache is not None:
+        embeddings = embedding_cache.get_many(embedding_deployment_name, inputs)
+    else:
+        embeddings = [None] * len(inputs)
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+
+    # Generate the embeddings one batch at a time, inputs of a failed batch are left as None
+    if token_counts is None:
+        token_counts = {i: estimate_token_count(inputs[i]) for i in missing}
+    for batch in batch_inputs([inputs[i] for i in missing], token_counts=[token_counts[i] for i in missing]):
+        batch = [missing[i] for i in batch]
+        # Define the request body
+        request_body = {
+            "input": [inputs[i] for i in batch]
+        }
+
+        try:
+            tokens = sum(token_counts[i] for i in batch)
+            response = send_request(get_openai_session(), "POST", url, embedding_rate_limiter, tokens, "embeddings", json=request_body, timeout=30)
+            response.raise_for_status()
+            embedding_response = response.json()
+            metrics.record_usage("embeddings", embedding_response.get("usage"))
+            # Map each embedding back to its input using the index in the response
+            for item in embedding_response["data"]:
+                embeddings[batch[item["index"]]] = item["embedding"]
+            if embedding_cache is not None:
+                embedding_cache.put_many(embedding_deployment_name, request_body["input"], [embeddings[i] for i in batch])
+        except requests.exceptions.RequestException as e:
+            print(f"Error generating query embeddings: {e}")
+    return embeddings
+
 def generate_chat_completion(messages):
     # Define the REST API endpoint
-    url = f"{base_url}/openai/deployments/{chat_deployment_name}/chat/completions?api-version={openai_api_version}"
+    url = f"{get_base_url()}/openai/deployments/{chat_deployment_name}/chat/completions?api-version={openai_api_version}"
 
     # Define the request body
     request_body = {
@@ -54,9 +164,12 @@ def generate_chat_completion(messages):
 
     # Generate the chat response
     try:
-        response = requests.post(url, headers=openai_headers, json=request_body, timeout=10)
+        tokens = sum(estimate_token_count(message["content"]) for message in messages)
+        response = send_request(get_openai_session(), "POST", url, chat_rate_limiter, tokens, "chat", json=request_body, timeout=10)
         response.raise_for_status()
-        return response.json()
+        chat_response = response.json()
+        metrics.record_usage("chat", chat_response.get("usage"))
+        return chat_response
     except Exception as e:
         print(f"Error generating chat response: {e}")
         return None
\ No newline at end of file
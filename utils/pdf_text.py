@@ -0,0 +1,288 @@
+import io
+import multiprocessing
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from utils.config import get_config
+from utils.metrics import metrics
+from utils.tokens import count_tokens
+
+# Get values from the config file
+config = get_config()
+# pypdf or pymupdf (faster, needs PyMuPDF)
+pdf_extractor = config.get('pdf', 'extractor', fallback='pypdf')
+# Worker processes for text extraction, 0 uses one per CPU and 1 extracts in this process
+pdf_processes = config.getint('pdf', 'processes', fallback=0) or os.cpu_count() or 1
+# Pages per shard, documents of one shard or less are always extracted in this process
+pdf_shard_pages = config.getint('pdf', 'shard_pages', fallback=32)
+# Target tokens per chunk, tokens repeated from the end of the previous chunk, and the smallest chunk
+# that is kept on its own instead of being merged into its neighbour
+chunk_tokens = config.getint('pdf', 'chunk_tokens', fallback=256)
+chunk_overlap_tokens = config.getint('pdf', 'chunk_overlap_tokens', fallback=32)
+min_chunk_tokens = config.getint('pdf', 'min_chunk_tokens', fallback=32)
+
+PAGE_SEPARATOR = "\n\n"
+
+# Split points, from the most to the least preferred, the separating whitespace belongs to neither side
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+|\n\s*\n")
+CLAUSE_BOUNDARY = re.compile(r"(?<=[,;:])\s+|\n")
+WORD_BOUNDARY = re.compile(r"\s+")
+
+def open_document(file_data, extractor=pdf_extractor):
+    # Open the PDF from memory with the configured extractor
+    if extractor == "pymupdf":
+        import fitz
+        return fitz.open(stream=file_data, filetype="pdf")
+    if extractor == "pypdf":
+        from pypdf import PdfReader
+        return PdfReader(io.BytesIO(file_data))
+    raise ValueError(f"Unknown PDF extractor '{extractor}', expected pypdf or pymupdf")
+
+def get_page_count(document):
+    return document.page_count if hasattr(document, "page_count") else len(document.pages)
+
+def load_pdf(document, start=0, stop=None):
+    # Extract the text one page at a time, yielding the page number with the page text
+    stop = get_page_count(document) if stop is None else stop
+    for page_number in range(start, stop):
+        with metrics.timed("parse_pdf"):
+            if hasattr(document, "page_count"):
+                page_text = document[page_number].get_text()
+            else:
+                page_text = document.pages[page_number].extract_text()
+        yield page_number, page_text
+
+class TokenSplitter:
+    """Packs sentence- and clause-aligned spans of text into chunks of about target_tokens tokens.
+
+    Consecutive chunks share up to overlap_tokens of whole spans. A chunk below min_tokens is
+    merged into its neighbour instead of being dropped, so no text is lost. Every chunk is a
+    substring of the input.
+    """
+
+    def __init__(self, target_tokens=chunk_tokens, overlap_tokens=chunk_overlap_tokens, min_tokens=min_chunk_tokens):
+        self.target_tokens = target_tokens
+        self.overlap_tokens = overlap_tokens
+        self.min_tokens = min_tokens
+
+    def spans(self, text, start, end, boundaries):
+        # Split text[start:end] into (start, end, tokens) spans no longer than the target, using the
+        # first boundary pattern and falling back to the next ones for spans that are still too long
+        pieces = []
+        position = start
+        for match in boundaries[0].finditer(text, start, end):
+            pieces.append((position, match.start()))
+            position = match.end()
+        pieces.append((position, end))
+
+        spans = []
+        for piece_start, piece_end in pieces:
+            if piece_start >= piece_end:
+                continue
+            tokens = count_tokens(text[piece_start:piece_end])
+            if tokens <= self.target_tokens:
+                spans.append((piece_start, piece_end, tokens))
+            elif len(boundaries) > 1:
+                spans.extend(self.spans(text, piece_start, piece_end, boundaries[1:]))
+            else:
+                # A single word longer than the target is cut by length
+                step = max(1, (piece_end - piece_start) * self.target_tokens // tokens)
+                for cut in range(piece_start, piece_end, step):
+                    spans.append((cut, min(cut + step, piece_end), count_tokens(text[cut:min(cut + step, piece_end)])))
+        return spans
+
+    def split_text(self, text):
+        spans = self.spans(text, 0, len(text), [SENTENCE_BOUNDARY, CLAUSE_BOUNDARY, WORD_BOUNDARY])
+
+        # Pack whole spans up to the target, a chunk still below the minimum takes the next span regardless
+        chunks = []
+        first = 0
+        while first < len(spans):
+            last = first
+            tokens = 0
+            while last < len(spans) and (last == first or tokens < self.min_tokens or tokens + spans[last][2] <= self.target_tokens):
+                tokens += spans[last][2]
+                last += 1
+            chunks.append([first, last, tokens])
+            if last == len(spans):
+                break
+            # Start the next chunk with the trailing spans that fit in the overlap, always moving forward
+            first = last
+            overlap = 0
+            while first - 1 > chunks[-1][0] and overlap + spans[first - 1][2] <= self.overlap_tokens:
+                first -= 1
+                overlap += spans[first][2]
+
+        # Merge a short last chunk into the one before it
+        if len(chunks) > 1 and chunks[-1][2] < self.min_tokens:
+            chunks[-2][1] = chunks.pop()[1]
+        return [text[spans[first][0]:spans[last - 1][1]] for first, last, _ in chunks]
+
+def get_splitter():
+    # Create a text splitter object
+    return TokenSplitter()
+
+def join_text(text, page_offsets, more_text, more_page_offsets):
+    # Append text to the buffer, separating the pages with a paragraph break so that the splitter prefers to split between them
+    if text:
+        text += PAGE_SEPARATOR
+    base = len(text)
+    return text + more_text, page_offsets + [(base + offset, page) for offset, page in more_page_offsets]
+
+def split_buffer(splitter, text, page_offsets, final=False):
+    # Split the buffered text into chunks. Unless final, the last chunk may continue in the text still to come,
+    # so it is returned as the new buffer with its page offsets instead of being emitted
+    chunks = splitter.split_text(text)
+    offsets = locate_chunks(text, chunks)
+    if final or not chunks:
+        return [chunk for chunk in map(make_chunk, chunks, offsets, [page_offsets] * len(chunks)) if chunk is not None], "", []
+    emitted = [chunk for chunk in map(make_chunk, chunks[:-1], offsets[:-1], [page_offsets] * len(chunks)) if chunk is not None]
+    carry_offset = offsets[-1]
+    carry_page = get_page_number(carry_offset, page_offsets)
+    carry_page_offsets = [(0, carry_page)] + [(offset - carry_offset, page) for offset, page in page_offsets if offset > carry_offset]
+    return emitted, text[carry_offset:], carry_page_offsets
+
+def split_text(pages):
+    # Split (page_number, page_text) pairs into chunks as the pages arrive.
+    # Only the text that has not been emitted yet is kept, along with the offsets where each page starts
+    splitter = get_splitter()
+    text = ""
+    page_offsets = []
+    for page_number, page_text in pages:
+        text, page_offsets = join_text(text, page_offsets, page_text, [(0, page_number)])
+        with metrics.timed("split_text"):
+            chunks, text, page_offsets = split_buffer(splitter, text, page_offsets)
+        yield from chunks
+
+    # Emit whatever is left after the last page
+    if text:
+        chunks, _, _ = split_buffer(splitter, text, page_offsets, final=True)
+        yield from chunks
+
+def locate_chunks(text, chunks):
+    # Find the start offset of each chunk in the text, the chunks are in order but may overlap
+    offsets = []
+    position = 0
+    for chunk in chunks:
+        offset = text.find(chunk, position)
+        if offset == -1:
+            offset = position
+        offsets.append(offset)
+        position = offset + 1
+    return offsets
+
+def get_page_number(offset, page_offsets):
+    # The page a chunk belongs to is the page its first character is on
+    page_number = page_offsets[0][1]
+    for page_offset, page in page_offsets:
+        if page_offset > offset:
+            break
+        page_number = page
+    return page_number
+
+def make_chunk(chunk, offset, page_offsets):
+    # Only skip chunks without any text, short ones are merged by the splitter, with the token count for request planning
+    chunk = chunk.strip()
+    if not chunk:
+        return None
+    return {"chunk": chunk, "page_number": get_page_number(offset, page_offsets), "tokens": count_tokens(chunk)}
+
+# The document opened once per worker process
+worker_document = None
+
+def init_worker(file_data, extractor):
+    global worker_document
+    worker_document = open_document(file_data, extractor)
+
+def process_shard(start, stop):
+    # Extract and split the pages [start, stop) in a worker process. The first chunk (head) and the text from
+    # the start of the last chunk (tail) may continue in the neighbouring shards, so they are returned as text
+    # for the parent to split across the boundary, only the chunks in between are final
+    text = ""
+    page_offsets = []
+    for page_number, page_text in load_pdf(worker_document, start, stop):
+        text, page_offsets = join_text(text, page_offsets, page_text, [(0, page_number)])
+    # The page timings collected by this worker's metrics are sent back to the parent
+    with metrics.lock:
+        parse_seconds = metrics.durations.pop("parse_pdf", [])
+
+    started = time.perf_counter()
+    chunks = get_splitter().split_text(text)
+    offsets = locate_chunks(text, chunks)
+    result = {"stop": stop, "parse_pdf": parse_seconds, "head": None, "chunks": [], "tail": (text, page_offsets)}
+    if len(chunks) >= 3:
+        head_end = offsets[0] + len(chunks[0])
+        tail_offset = offsets[-1]
+        result["head"] = (text[:head_end], [(offset, page) for offset, page in page_offsets if offset < head_end])
+        result["chunks"] = [chunk for chunk in map(make_chunk, chunks[1:-1], offsets[1:-1], [page_offsets] * len(chunks)) if chunk is not None]
+        result["tail"] = (text[tail_offset:], [(0, get_page_number(tail_offset, page_offsets))] + [(offset - tail_offset, page) for offset, page in page_offsets if offset > tail_offset])
+    result["split_text"] = time.perf_counter() - started
+    return result
+
+def split_shards(file_data, page_count, extractor, processes, shard_pages, on_pages=None):
+    # Extract and split page-range shards in a process pool, merging the chunks back in page order.
+    # The tail of each shard and the head of the next are split together, so chunks overlap across shards
+    # as they do within one
+    shards = iter([(start, min(start + shard_pages, page_count)) for start in range(0, page_count, shard_pages)])
+    splitter = get_splitter()
+    text = ""
+    page_offsets = []
+    # Spawned workers do not inherit the locks of this process' threads
+    executor = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn"), initializer=init_worker, initargs=(file_data, extractor))
+    try:
+        # At most two shards per worker are in flight, the results are consumed in order
+        pending = deque()
+        for shard in shards:
+            pending.append(executor.submit(process_shard, *shard))
+            if len(pending) >= processes * 2:
+                break
+        while pending:
+            result = pending.popleft().result()
+            shard = next(shards, None)
+            if shard is not None:
+                pending.append(executor.submit(process_shard, *shard))
+
+            for seconds in result["parse_pdf"]:
+                metrics.record("parse_pdf", seconds)
+            metrics.record("split_text", result["split_text"])
+            if on_pages is not None:
+                on_pages(result["stop"])
+
+            started = time.perf_counter()
+            if result["head"] is not None:
+                text, page_offsets = join_text(text, page_offsets, *result["head"])
+                chunks, _, _ = split_buffer(splitter, text, page_offsets, final=True)
+                chunks.extend(result["chunks"])
+                text, page_offsets = result["tail"]
+            else:
+                text, page_offsets = join_text(text, page_offsets, *result["tail"])
+                chunks, text, page_offsets = split_buffer(splitter, text, page_offsets)
+            metrics.record("split_text", time.perf_counter() - started)
+            yield from chunks
+
+        # Emit whatever is left after the last shard
+        if text:
+            chunks, _, _ = split_buffer(splitter, text, page_offsets, final=True)
+            yield from chunks
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def iter_chunks(file_data, extractor=pdf_extractor, processes=pdf_processes, shard_pages=pdf_shard_pages, on_pages=None):
+    # Yield the chunks of the PDF in page order, on_pages(pages_parsed) is called as the pages are extracted.
+    # Documents longer than one shard are extracted across worker processes when more than one is configured
+    document = open_document(file_data, extractor)
+    page_count = get_page_count(document)
+    if processes > 1 and page_count > shard_pages:
+        del document
+        yield from split_shards(file_data, page_count, extractor, min(processes, -(-page_count // shard_pages)), shard_pages, on_pages)
+        return
+
+    def read_pages():
+        for page_number, page_text in load_pdf(document):
+            if on_pages is not None:
+                on_pages(page_number + 1)
+            yield page_number, page_text
+
+    yield from split_text(read_pages())
@@ -0,0 +1,76 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+class ResultCache:
+    """Disk-backed cache of chat classification results.
+
+    Entries expire ttl_seconds after they were written (0 disables expiry). When the number
+    of entries exceeds max_entries the least recently used entries are evicted.
+    """
+
+    def __init__(self, path, max_entries=100000, ttl_seconds=0):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # The cache is shared by the app and the worker processes, so writers wait for each other instead of failing
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, result TEXT NOT NULL, created REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+        self.connection.commit()
+
+    @staticmethod
+    def make_key(*parts):
+        # Hash the parts with a separator so that different splits of the same text never collide
+        return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute("SELECT result, created FROM results WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl_seconds and now - row[1] > self.ttl_seconds:
+                self.connection.execute("DELETE FROM results WHERE key = ?", (key,))
+                self.connection.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute("UPDATE results SET last_access = ? WHERE key = ?", (now, key))
+            self.connection.commit()
+            return row[0]
+
+    def put(self, key, result):
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO results (key, result, created, last_access) VALUES (?, ?, ?, ?)",
+                (key, result, now, now),
+            )
+            self.evict(now)
+            self.connection.commit()
+
+    def evict(self, now):
+        if self.ttl_seconds:
+            self.connection.execute("DELETE FROM results WHERE created < ?", (now - self.ttl_seconds,))
+        count = self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        if count > self.max_entries:
+            self.connection.execute(
+                "DELETE FROM results WHERE key IN "
+                "(SELECT key FROM results ORDER BY last_access ASC LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses}
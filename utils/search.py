@@ -1,19 +1,26 @@
 import requests
 import json
-import configparser
 import os
-
-# Get the path to the config.ini file
-config_path = os.path.join(os.path.dirname(__file__), '..', 'settings', 'config.ini')
-
-# Read the config.ini file
-config = configparser.ConfigParser()
-config.read(config_path)
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from utils.config import get_config, get_path, require
+from utils.client import RateLimiter, create_session, send_request
+from utils.metrics import bind_metrics
+from utils.vote import fast_path_enabled
 
 # Get values from the config file
-index_name = config.get('search', 'index_name')
-search_service_name = config.get('search', 'search_service_name')
-search_api_key = config.get('search', 'search_api_key')
+config = get_config()
+index_name = config.get('search', 'index_name', fallback='')
+search_backend = config.get('search', 'backend', fallback='azure')
+# Client-side request budget, 0 disables the limit
+search_requests_per_minute = config.getint('search', 'search_requests_per_minute', fallback=0)
+# Relative index paths are resolved against the repository root
+local_index_path = get_path('search', 'local_index_path', 'data/index.npz')
+manifest_path = get_path('search', 'manifest_path', 'data/index_manifest.json')
+embedding_store_path = get_path('search', 'embedding_store_path', 'data/embeddings')
+# float32, float16 or int8
+embedding_store_dtype = config.get('search', 'embedding_store_dtype', fallback='float32')
 
 # Define the ANSI escape codes for coloured text
 RED = "\033[31m"
@@ -24,13 +31,88 @@ RESET = "\033[0m"
 
 # Define the variable values
 search_api_version = "2023-07-01-Preview"
-search_headers = {"Content-Type": "application/json", "api-key": search_api_key}
-base_url = f"https://{search_service_name}.search.windows.net"
 
+# Fields returned by a search, the label is only needed by the fast path and indexes built before it have no such field
+search_select = "content, category, isSpecialCommitment" if fast_path_enabled else "content, category"
+
+# Rate limiter shared by all requests to the service
+search_rate_limiter = RateLimiter(search_requests_per_minute)
+
+# The keep-alive session is created on first use, so that importing this module does not need the credentials
+search_session = None
+search_session_lock = threading.Lock()
+
+def get_base_url():
+    # Every request to the service addresses the configured index
+    require('search', 'index_name')
+    endpoint = config.get('search', 'search_endpoint', fallback='')
+    if endpoint:
+        return endpoint.rstrip("/")
+    return f"https://{require('search', 'search_service_name')}.search.windows.net"
+
+def get_search_session():
+    # Shared keep-alive session for all requests to the service
+    global search_session
+    with search_session_lock:
+        if search_session is None:
+            search_session = create_session({"Content-Type": "application/json", "api-key": require('search', 'search_api_key')})
+        return search_session
+
+# Limits for uploading documents, the service accepts at most 1000 documents or 16 MB per request
+upload_batch_size = 1000
+upload_batch_bytes = 8 * 1024 * 1024
+upload_max_workers = 4
+upload_max_retries = 3
+upload_timeout = 60
+upload_retryable_status_codes = (409, 422, 503)
+
+# The local index is loaded on first use and shared by all threads
+local_index = None
+local_index_lock = threading.Lock()
+
+def get_embedding_store():
+    # The local index searches the memory-mapped vectors of the embedding store written by populate_vector_index.py
+    from utils.embedding_store import EmbeddingStore
+    return EmbeddingStore.load(embedding_store_path) if EmbeddingStore.exists(embedding_store_path) else None
+
+def get_local_index():
+    global local_index
+    with local_index_lock:
+        if local_index is None:
+            from utils.local_search import LocalVectorIndex
+            local_index = LocalVectorIndex.load(local_index_path, get_embedding_store())
+        return local_index
+
+def save_local_index(documents):
+    # Build the local index from documents in the search upload format and persist it
+    global local_index
+    from utils.local_search import LocalVectorIndex
+    index = LocalVectorIndex.from_documents(documents, get_embedding_store())
+    index.save(local_index_path)
+    with local_index_lock:
+        local_index = index
+    print(f"Local index {ORANGE}{local_index_path}{RESET} {GREEN}saved{RESET} with {len(index)} documents.")
+
+def sync_local_index(documents, removed_ids):
+    # Apply additions and removals to the persisted local index, rebuilding it if it does not exist yet
+    if not os.path.exists(local_index_path):
+        save_local_index(documents)
+        return
+    global local_index
+    from utils.local_search import LocalVectorIndex
+    index = LocalVectorIndex.updated(local_index_path, documents, removed_ids, get_embedding_store())
+    index.save(local_index_path)
+    with local_index_lock:
+        local_index = index
+    print(f"Local index {ORANGE}{local_index_path}{RESET} {GREEN}synced{RESET}: {len(documents)} added, {len(removed_ids)} removed, {len(index)} total.")
 
 def query_search_index(embedding, number_of_nearest_neighbors=1):
+    # Answer from the in-process index when the local backend is configured
+    if search_backend == "local":
+        return get_local_index().query(embedding, number_of_nearest_neighbors)
+
     # Define the REST API endpoints
-    url = f"{base_url}/indexes/{index_name}/docs/search?api-version={search_api_version}"
+    url = f"{get_base_url()}/indexes/{index_name}/docs/search?api-version={search_api_version}"
 
     # Define the request body
     request_body = {
@@ -39,16 +121,41 @@ def query_search_index(embedding, number_of_nearest_neighbors=1):
             "fields": "contentVector",
             "k": number_of_nearest_neighbors
         },
-        "select": "content, category"
+        "select": search_select
     }
 
-    # Query the search index
-    response = requests.post(url, headers=search_headers, json=request_body)
-    return response.json()
+    # Query the search index, an empty result is returned if the request fails
+    try:
+        response = send_request(get_search_session(), "POST", url, search_rate_limiter, 0, "search", json=request_body, timeout=10)
+        response.raise_for_status()
+        return response.json()
+    except requests.exceptions.RequestException as e:
+        if e.response is not None and e.response.status_code == 400 and "isSpecialCommitment" in e.response.text:
+            print(f"Error querying search index: index {index_name} has no isSpecialCommitment field, run populate_vector_index.py to rebuild it for the fast path.")
+        else:
+            print(f"Error querying search index: {e}")
+        return {"value": []}
+
+def query_search_index_batch(embeddings, number_of_nearest_neighbors=1, max_workers=8):
+    # Failed (None) embeddings get an empty result
+    results = [{"value": []} for _ in embeddings]
+    valid = [i for i, embedding in enumerate(embeddings) if embedding is not None]
+    if not valid:
+        return results
+
+    # The local backend answers every query with one matrix multiply, Azure is queried once per embedding concurrently
+    if search_backend == "local":
+        valid_results = get_local_index().query_batch([embeddings[i] for i in valid], number_of_nearest_neighbors)
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            valid_results = list(executor.map(bind_metrics(lambda i: query_search_index(embeddings[i], number_of_nearest_neighbors)), valid))
+    for i, result in zip(valid, valid_results):
+        results[i] = result
+    return results
 
 def create_search_index():
     # Define the REST API endpoints
-    url = f"{base_url}/indexes/{index_name}?api-version={search_api_version}"
+    url = f"{get_base_url()}/indexes/{index_name}?api-version={search_api_version}"
 
     # Define the request body
     request_body = {
@@ -57,6 +164,7 @@ def create_search_index():
             {"name": "id", "type": "Edm.String", "key": True, "filterable": True},
             {"name": "content","type": "Edm.String","searchable": True,"retrievable": True},
             {"name": "category","type": "Edm.String","filterable": True,"searchable": True,"retrievable": True},
+            {"name": "isSpecialCommitment","type": "Edm.String","filterable": True,"retrievable": True},
             {"name": "contentVector","type": "Collection(Edm.Single)","searchable": True,"retrievable": True,"dimensions": 1536,"vectorSearchConfiguration": "my-vector-config"}
         ],
         "corsOptions": {"allowedOrigins": ["*"],"maxAgeInSeconds": 60},
@@ -65,22 +173,35 @@ def create_search_index():
     }
 
     # Create the search index
-    response = requests.put(url, headers=search_headers, json=request_body)
+    response = send_request(get_search_session(), "PUT", url, search_rate_limiter, 0, "search", json=request_body, timeout=30)
     if response.status_code == 201:
         print(f"Index {ORANGE}{index_name}{RESET} {BLUE}created{RESET}.")
     else:
         print(f"Error creating index {index_name}: {response.text}")
 
+def get_search_index_fields():
+    # Define the REST API endpoints
+    url = f"{get_base_url()}/indexes/{index_name}?api-version={search_api_version}"
+
+    # Return the field names of the search index, or None if it does not exist. Any other failure is raised,
+    # so that an unreachable or unauthorized service is not mistaken for a missing index
+    response = send_request(get_search_session(), "GET", url, search_rate_limiter, 0, "search", timeout=10)
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200:
+        raise Exception(f"Error reading index {index_name}: {response.status_code} {response.text}")
+    return [field["name"] for field in response.json().get("fields", [])]
+
 def delete_search_index():
     # Define the REST API endpoints
-    url = f"{base_url}/indexes/{index_name}?api-version={search_api_version}"
+    url = f"{get_base_url()}/indexes/{index_name}?api-version={search_api_version}"
 
     # Delete the search index if it exists
-    response = requests.get(url, headers=search_headers)
+    response = send_request(get_search_session(), "GET", url, search_rate_limiter, 0, "search", timeout=10)
     if response.status_code == 200:
         # Index exists, delete it
         print(f"Index {ORANGE}{index_name}{RESET} exists.")
-        response = requests.delete(url, headers=search_headers)
+        response = send_request(get_search_session(), "DELETE", url, search_rate_limiter, 0, "search", timeout=30)
         if response.status_code == 204:
             print(f"Index {ORANGE}{index_name}{RESET} {RED}deleted{RESET}.")
         else:
@@ -88,14 +209,78 @@ def delete_search_index():
     else:
         print(f"Index {ORANGE}{index_name}{RESET} does not exist.")
 
+def serialize_value(value):
+    # Vectors from the embedding store are serialized through their tolist method
+    return value.tolist()
+
+def batch_documents(documents, batch_size=upload_batch_size, batch_bytes=upload_batch_bytes):
+    # Serialize the documents as the batches are built, bounded by document count and payload size
+    batch = []
+    size = 0
+    for key, document in documents:
+        document = json.dumps(document, default=serialize_value)
+        if batch and (len(batch) >= batch_size or size + len(document) > batch_bytes):
+            yield batch
+            batch = []
+            size = 0
+        batch.append((key, document))
+        size += len(document) + 1
+    if batch:
+        yield batch
+
+def upload_batch(url, batch):
+    # Upload one batch and return the keys of the documents that failed with a retryable status
+    data = '{"value": [' + ",".join(document for _, document in batch) + "]}"
+    response = send_request(get_search_session(), "POST", url, search_rate_limiter, 0, "search", data=data.encode("utf-8"), timeout=upload_timeout)
+    # A throttled or unavailable service rejects the whole batch, retry every key in it
+    if response.status_code in (429, 503):
+        return [key for key, _ in batch]
+    if response.status_code not in (200, 207):
+        response.raise_for_status()
+    failed = []
+    for result in response.json()["value"]:
+        if not result["status"]:
+            if result["statusCode"] not in upload_retryable_status_codes:
+                raise Exception(f"Error uploading document {result['key']}: {result.get('errorMessage')}")
+            failed.append(result["key"])
+    return failed
+
 def upload_documents_to_search_index(payload):
     # Define the list of documents to upload
-    url = f"{base_url}/indexes/{index_name}/docs/index?api-version={search_api_version}"
+    url = f"{get_base_url()}/indexes/{index_name}/docs/index?api-version={search_api_version}"
+
+    # Key the documents by id, they are only serialized batch by batch while uploading
+    pending = {document["id"]: document for document in payload["value"]}
 
-    # Call the upload docs endpoint
+    # Call the upload docs endpoint with several batches in flight, then retry only the failed keys
     try:
-        response = requests.post(url, headers=search_headers, data=json.dumps(payload), timeout=10)
-        response.raise_for_status()
-        print(f"Documents {GREEN}uploaded{RESET} successfully.")
+        for attempt in range(upload_max_retries + 1):
+            if attempt > 0:
+                print(f"Retrying {len(pending)} failed documents (attempt {attempt} of {upload_max_retries})...")
+                time.sleep(2 ** attempt)
+            failed = []
+            in_flight = set()
+            with ThreadPoolExecutor(max_workers=upload_max_workers) as executor:
+                for batch in batch_documents(pending.items()):
+                    # Only a few serialized batches are held in memory at a time
+                    if len(in_flight) >= 2 * upload_max_workers:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            failed.extend(future.result())
+                    in_flight.add(executor.submit(upload_batch, url, batch))
+                for future in as_completed(in_flight):
+                    failed.extend(future.result())
+            pending = {key: pending[key] for key in failed}
+            if not pending:
+                print(f"Documents {GREEN}uploaded{RESET} successfully.")
+                return
+        raise Exception(f"Error uploading documents: {len(pending)} documents failed after {upload_max_retries} retries: {', '.join(pending)}")
     except requests.exceptions.RequestException as e:
         raise Exception(f"Error uploading documents: {e}")
+
+def delete_documents_from_search_index(ids):
+    # Issue a delete action for every id through the upload docs endpoint
+    payload = {
+        "value": [{"@search.action": "delete", "id": id} for id in ids]
+    }
+    upload_documents_to_search_index(payload)
@@ -0,0 +1,28 @@
+import threading
+
+# The cl100k_base encoding is shared by gpt-35-turbo and text-embedding-ada-002
+ENCODING_NAME = "cl100k_base"
+
+# tiktoken is loaded on first use, without it (or its encoding files) tokens are estimated from the length
+encoding = None
+encoding_loaded = False
+encoding_lock = threading.Lock()
+
+def get_encoding():
+    global encoding, encoding_loaded
+    with encoding_lock:
+        if not encoding_loaded:
+            try:
+                import tiktoken
+                encoding = tiktoken.get_encoding(ENCODING_NAME)
+            except Exception:
+                encoding = None
+            encoding_loaded = True
+        return encoding
+
+def count_tokens(text):
+    # Exact token count with tiktoken, otherwise about four characters per token for English text
+    encoding = get_encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
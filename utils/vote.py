@@ -0,0 +1,48 @@
+from utils.config import get_config
+
+# Get values from the config file
+config = get_config()
+# The scores are search scores, so the thresholds must be calibrated for the configured search backend
+fast_path_enabled = config.getboolean('classifier', 'fast_path_enabled', fallback=False)
+fast_path_neighbors = config.getint('classifier', 'fast_path_neighbors', fallback=5)
+fast_path_min_score = config.getfloat('classifier', 'fast_path_min_score', fallback=0.9)
+fast_path_min_margin = config.getfloat('classifier', 'fast_path_min_margin', fallback=0.6)
+
+def weighted_vote(results, key):
+    # Sum the similarity scores of the neighbours per key and return [(key, weight), ...] best first
+    weights = {}
+    for result in results:
+        weights[key(result)] = weights.get(key(result), 0) + result["@search.score"]
+    return sorted(weights.items(), key=lambda item: item[1], reverse=True)
+
+def vote_margin(ranked):
+    # The winner's lead over the runner-up as a share of the total weight
+    total = sum(weight for _, weight in ranked)
+    if total <= 0:
+        return 0
+    runner_up = ranked[1][1] if len(ranked) > 1 else 0
+    return (ranked[0][1] - runner_up) / total
+
+def rank_categories(results):
+    # Return the candidate categories best first, with the vote margin of the top category
+    ranked = weighted_vote(results, lambda result: result["category"])
+    return [category for category, _ in ranked], vote_margin(ranked)
+
+def fast_path_verdict(results, min_score=fast_path_min_score, min_margin=fast_path_min_margin):
+    # Return the verdict of a decisive vote over (category, label) pairs of labelled neighbours, or None.
+    # Neighbours without an is_special_commitment label make the vote undecidable
+    if not results or any(not result.get("isSpecialCommitment") for result in results):
+        return None
+    if results[0]["@search.score"] < min_score:
+        return None
+    ranked = weighted_vote(results, lambda result: (result["category"], result["isSpecialCommitment"].upper()))
+    margin = vote_margin(ranked)
+    if margin < min_margin:
+        return None
+    (category, is_special_commitment), _ = ranked[0]
+    return {
+        "category": category,
+        "is_special_commitment": is_special_commitment,
+        "score": results[0]["@search.score"],
+        "margin": margin,
+    }
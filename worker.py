@@ -0,0 +1,127 @@
+import argparse
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import traceback
+from utils.jobs import get_job_queue, job_workers, job_poll_seconds, job_stale_seconds
+
+# Define the ANSI escape codes for coloured text
+RED = "\033[31m"
+GREEN = "\033[32m"
+ORANGE = "\033[38;5;208m"
+RESET = "\033[0m"
+
+# Finished rows are checkpointed in batches of this size, or when the heartbeat is due
+CHECKPOINT_ROWS = 16
+
+def run_job(queue, job):
+    # Run the embed, search, evaluate and annotate pipeline for one job, resuming after its checkpointed chunks
+    from chat import chat_pack_size
+    from pipeline import MAX_WORKERS, annotate_pdf, process_chunks
+    from utils.metrics import metrics
+    from utils.pdf_text import iter_chunks, open_document, get_page_count, pdf_processes
+
+    job_id = job["id"]
+    options = job["options"]
+    with open(queue.file_path(job_id, "pdf"), "rb") as f:
+        file_data = f.read()
+    num_pages = get_page_count(open_document(file_data))
+    done_rows = queue.rows(job_id)
+    if done_rows:
+        print(f"Job {ORANGE}{job_id}{RESET} resumes after {len(done_rows)} checkpointed chunks.")
+
+    lock = threading.Lock()
+    buffered = []
+    pages_read = 0
+    stopped = threading.Event()
+
+    def flush():
+        with lock:
+            rows = list(buffered)
+            buffered.clear()
+        queue.checkpoint(job_id, rows, pages_read, num_pages)
+
+    def heartbeat():
+        # Keep the claim alive while no rows finish, e.g. while a long document is parsed
+        while not stopped.wait(job_stale_seconds / 4):
+            flush()
+
+    def on_pages(pages):
+        nonlocal pages_read
+        pages_read = pages
+
+    def on_row(row):
+        with lock:
+            buffered.append(row)
+            full = len(buffered) >= CHECKPOINT_ROWS
+        if full:
+            flush()
+
+    # The worker processes share the CPUs for text extraction
+    processes = max(1, pdf_processes // job_workers)
+    metrics.reset()
+    heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+    heartbeat_thread.start()
+    try:
+        rows = process_chunks(
+            iter_chunks(file_data, processes=processes, on_pages=on_pages),
+            options.get("max_workers", MAX_WORKERS),
+            deduplicate=options.get("deduplicate", True),
+            pack_size=options.get("pack_size", chat_pack_size),
+            done_rows=done_rows,
+            on_row=on_row,
+        )
+    finally:
+        stopped.set()
+        heartbeat_thread.join()
+    flush()
+
+    with metrics.timed("annotate_pdf"):
+        annotated_pdf, unmatched = annotate_pdf(file_data, rows)
+    with open(queue.file_path(job_id, "metrics.json"), "w") as f:
+        f.write(metrics.to_json())
+    queue.finish(job_id, annotated_pdf, unmatched)
+    print(f"Job {ORANGE}{job_id}{RESET} {GREEN}done{RESET}: {len(rows)} chunks.")
+
+def work(once=False):
+    # Claim and run jobs until stopped, or until the queue is empty with once
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    queue = get_job_queue()
+    while True:
+        job = queue.claim(worker)
+        if job is None:
+            if once:
+                return
+            time.sleep(job_poll_seconds)
+            continue
+        print(f"Job {ORANGE}{job['id']}{RESET} ({job['name']}) claimed by {worker}.")
+        try:
+            run_job(queue, job)
+        except Exception as e:
+            traceback.print_exc()
+            print(f"Job {ORANGE}{job['id']}{RESET} {RED}failed{RESET}: {e}")
+            queue.fail(job["id"], e)
+
+if __name__ == "__main__":
+    # Parse command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=job_workers, help="the number of documents classified in parallel, one per worker process")
+    parser.add_argument("--once", action="store_true", help="exit once the queue is empty instead of polling for new jobs")
+    args = parser.parse_args()
+
+    if args.workers <= 1:
+        work(args.once)
+    else:
+        # Spawned workers do not inherit the locks or open connections of this process
+        context = multiprocessing.get_context("spawn")
+        processes = [context.Process(target=work, args=(args.once,)) for _ in range(args.workers)]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()